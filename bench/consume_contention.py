@@ -0,0 +1,86 @@
+"""Стресс-тест ``consume_view`` под конкуренцией: много потоков бьют в одну ссылку.
+
+Проверяет, что отдано ровно ``views`` просмотров, и печатает задержки.
+Запуск: ``python -m bench.consume_contention [--threads N] [--views V] [--processes]``.
+С ``--processes`` потоки запускаются в нескольких процессах (как несколько
+воркеров link_server на одной БД).
+"""
+
+from __future__ import annotations
+
+import argparse
+import multiprocessing
+import statistics
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from bench.links import use_temp_storage
+from bot import links
+
+
+def _hammer(root: str, token: str, threads: int, attempts: int) -> tuple[int, list[float]]:
+    use_temp_storage(Path(root))
+    served = [0] * threads
+    latencies: list[list[float]] = [[] for _ in range(threads)]
+    start = threading.Barrier(threads)
+
+    def worker(i: int) -> None:
+        start.wait()
+        for _ in range(attempts):
+            t0 = time.perf_counter()
+            if links.consume_view(token) is not None:
+                served[i] += 1
+            latencies[i].append(time.perf_counter() - t0)
+
+    pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    return sum(served), [x for lat in latencies for x in lat]
+
+
+def _hammer_star(args: tuple[str, str, int, int]) -> tuple[int, list[float]]:
+    return _hammer(*args)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--views", type=int, default=500)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--processes", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        use_temp_storage(Path(tmp))
+        failures = 0
+        all_lat: list[float] = []
+        for _ in range(args.rounds):
+            token = links.create_link(b"x", args.views).token
+            # Попыток заметно больше, чем просмотров: часть запросов должна получить 410
+            attempts = args.views * 2 // args.threads + 1
+            if args.processes:
+                job = (tmp, token, args.threads, attempts)
+                with multiprocessing.get_context("spawn").Pool(args.processes) as pool:
+                    results = pool.map(_hammer_star, [job] * args.processes)
+                served = sum(r[0] for r in results)
+                lat = [x for r in results for x in r[1]]
+            else:
+                served, lat = _hammer(tmp, token, args.threads, attempts)
+            all_lat += lat
+            status = "ok" if served == args.views else "MISMATCH"
+            failures += served != args.views
+            print(f"served {served} of {args.views}: {status}")
+        all_lat.sort()
+        p50 = statistics.median(all_lat) * 1e6
+        p99 = all_lat[int(len(all_lat) * 0.99)] * 1e6
+        print(f"latency p50 {p50:.0f} us, p99 {p99:.0f} us, {len(all_lat)} calls")
+        if failures:
+            raise SystemExit(f"{failures} round(s) served the wrong number of views")
+
+
+if __name__ == "__main__":
+    main()
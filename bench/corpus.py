@@ -0,0 +1,65 @@
+"""Фиксированный синтетический корпус для бенчмарков.
+
+Картинки детерминированы (градиент + шум с фиксированной амплитудой), поэтому
+размер и сложность для кодеков одинаковы от запуска к запуску: результаты разных
+версий Pillow и кода сравнимы между собой.
+"""
+
+from __future__ import annotations
+
+import io
+from dataclasses import dataclass
+
+from PIL import Image, ImageChops
+
+
+@dataclass(frozen=True)
+class Sample:
+    name: str
+    width: int
+    height: int
+    format: str  # "JPEG" или "PNG"
+    alpha: bool = False
+
+    @property
+    def megapixels(self) -> float:
+        return self.width * self.height / 1e6
+
+
+IMAGES = (
+    Sample("jpeg_0.3mp", 640, 480, "JPEG"),
+    Sample("jpeg_2mp", 1600, 1200, "JPEG"),
+    Sample("jpeg_12mp", 4000, 3000, "JPEG"),
+    Sample("jpeg_24mp", 6000, 4000, "JPEG"),
+    Sample("png_alpha_4mp", 2304, 1728, "PNG", alpha=True),
+    Sample("panorama_8000x600", 8000, 600, "JPEG"),
+    Sample("tall_500x6000", 500, 6000, "JPEG"),
+)
+
+# В быстром режиме — без самых тяжёлых кадров
+QUICK_IMAGES = tuple(s for s in IMAGES if s.megapixels <= 5)
+
+CAPTIONS = {
+    "short": "©",
+    "latin": "@watermark sample",
+    "cyrillic": "Фото: Студия «Пример», Москва",
+    "emoji": "📸 Лучшие моменты ✨🔥",
+    "long": "Все права защищены. Копирование и публикация без согласия автора запрещены. " * 3,
+}
+
+
+def make_image(sample: Sample) -> bytes:
+    """Кодирует образец в байты (похоже на фото по размеру файла и сложности)."""
+    size = (sample.width, sample.height)
+    gray = Image.linear_gradient("L").resize(size)
+    noise = Image.effect_noise(size, 24).point(lambda v: v // 4)
+    base = ImageChops.add(gray, noise)
+    image = Image.merge("RGB", (base, base.rotate(180), gray))
+    if sample.alpha:
+        image.putalpha(Image.linear_gradient("L").rotate(90).resize(size))
+    out = io.BytesIO()
+    if sample.format == "JPEG":
+        image.save(out, "JPEG", quality=90)
+    else:
+        image.save(out, "PNG", compress_level=1)
+    return out.getvalue()
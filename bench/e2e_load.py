@@ -0,0 +1,415 @@
+"""Сквозная нагрузка на бота через локальный Bot API (:mod:`bench.fake_telegram`).
+
+Бот запускается отдельным процессом в выбранном режиме и ходит в поддельный
+Bot API через ``TELEGRAM_API_URL``:
+
+- ``polling`` — ``python -m bot`` (``bot.main``), апдейты отдаются через ``getUpdates``;
+- ``webhook`` — ``bot.main`` со встроенным aiohttp-webhook, апдейты приходят POST-ом;
+- ``flask`` — ``bot.flask_app`` под многопоточным werkzeug, апдейты приходят POST-ом.
+
+``--users`` пользователей проходят диалог «фото → подпись → число открытий».
+Новые диалоги начинаются с частотой ``--rate`` в секунду (на всех); если все
+пользователи заняты, старт ждёт — число опоздавших стартов показывает, что бот
+не успевает. Шаг считается завершённым, когда бот отвечает ``sendMessage``
+(на последнем шаге — сообщением со ссылкой).
+
+Для каждой частоты из ``--rates`` печатаются апдейты в секунду, перцентили
+задержки по шагам и задержка event loop бота (замеряется в процессе бота) и
+самого теста. Точка насыщения — частота, на которой завершённых диалогов
+становится меньше начатых, а p99 резко растёт.
+
+Запуск: ``python -m bench.e2e_load --mode polling --users 50 --rates 1,2,5,10``.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Optional
+
+import aiohttp
+
+from bench.corpus import IMAGES, make_image
+from bench.fake_telegram import FakeBotAPI
+from bench.link_load import _free_port
+
+STEPS = ("photo", "caption", "views")
+TOKEN = "123456:load-test"
+LAG_INTERVAL = 0.05
+
+
+# --- замер задержки event loop ---
+
+
+class LagProbe:
+    """Раз в ``interval`` засыпает и записывает, насколько позже проснулся."""
+
+    def __init__(self, interval: float = LAG_INTERVAL) -> None:
+        self.interval = interval
+        self.samples: list[tuple[float, float]] = []  # (time.time(), задержка в секундах)
+
+    async def run(self, path: Optional[Path] = None) -> None:
+        flushed = 0
+        last_flush = time.monotonic()
+        while True:
+            t0 = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.samples.append((time.time(), now - t0 - self.interval))
+            if path is not None and now - last_flush >= 1.0:
+                # Процесс бота могут остановить в любой момент — пишем по ходу
+                with path.open("a") as f:
+                    f.writelines(f"{t:.3f} {lag:.6f}\n" for t, lag in self.samples[flushed:])
+                flushed = len(self.samples)
+                last_flush = now
+
+    def window(self, start: float, end: float) -> list[float]:
+        return [lag for t, lag in self.samples if start <= t <= end]
+
+
+def _read_lag(path: Path, start: float, end: float) -> list[float]:
+    if not path.exists():
+        return []
+    lags = []
+    for line in path.read_text().splitlines():
+        t, lag = map(float, line.split())
+        if start <= t <= end:
+            lags.append(lag)
+    return lags
+
+
+def _bot_child(mode: str, lag_path: str) -> None:
+    """Процесс бота: настоящая точка входа режима плюс :class:`LagProbe` в его loop."""
+    probe = LagProbe()
+    if mode == "flask":
+        from werkzeug.serving import run_simple
+
+        from bot import flask_app
+
+        asyncio.run_coroutine_threadsafe(probe.run(Path(lag_path)), flask_app.bg_loop)
+        port = int(os.environ["WEBHOOK_PORT"])
+        run_simple("127.0.0.1", port, flask_app.flask_app, threaded=True)
+        return
+
+    from bot import main as bot_main
+
+    async def run() -> None:
+        task = asyncio.create_task(probe.run(Path(lag_path)))
+        try:
+            await bot_main.main()
+        finally:
+            task.cancel()
+
+    asyncio.run(run())
+
+
+# --- пользователи ---
+
+
+class Stats:
+    def __init__(self) -> None:
+        self.latency: dict[str, list[float]] = defaultdict(list)
+        self.updates = 0
+        self.flows = 0
+        self.failed: dict[str, int] = defaultdict(int)
+        self.deferred = 0
+
+    def report(self, seconds: float) -> dict[str, Any]:
+        steps = {}
+        for step in STEPS:
+            values = sorted(self.latency[step])
+            n = len(values)
+            steps[step] = {
+                "count": n,
+                **{
+                    f"p{q}_ms": values[min(n - 1, int(n * q / 100))] * 1000 if n else 0.0
+                    for q in (50, 90, 99)
+                },
+                "max_ms": values[-1] * 1000 if n else 0.0,
+            }
+        return {
+            "updates_per_s": self.updates / seconds,
+            "flows_per_s": self.flows / seconds,
+            "flows": self.flows,
+            "failed": dict(self.failed),
+            "deferred": self.deferred,
+            "steps": steps,
+        }
+
+
+def _lag_report(lags: list[float]) -> dict[str, float]:
+    lags = sorted(lags)
+    n = len(lags)
+    if not n:
+        return {"p50_ms": 0.0, "p99_ms": 0.0, "max_ms": 0.0}
+    return {
+        "p50_ms": lags[n // 2] * 1000,
+        "p99_ms": lags[min(n - 1, int(n * 0.99))] * 1000,
+        "max_ms": lags[-1] * 1000,
+    }
+
+
+class LoadDriver:
+    def __init__(self, api: FakeBotAPI, args: argparse.Namespace, bot_url: str) -> None:
+        self.api = api
+        self.args = args
+        self.bot_url = bot_url
+        self.replies: dict[int, asyncio.Queue[tuple[str, dict[str, Any]]]] = {}
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.stats = Stats()
+        api.on_reply = self._on_reply
+        sample = next(s for s in IMAGES if s.name == args.image)
+        content = make_image(sample)
+        # Свой file_id у каждого пользователя: кэш отправленных фото не срабатывает
+        self.photos = {
+            chat_id: api.add_file(content, sample.width, sample.height)
+            for chat_id in self._chat_ids()
+        }
+
+    def _chat_ids(self) -> range:
+        return range(100_001, 100_001 + self.args.users)
+
+    def _on_reply(self, chat_id: int, method: str, params: dict[str, Any]) -> None:
+        queue = self.replies.get(chat_id)
+        if queue is not None:
+            queue.put_nowait((method, params))
+
+    async def _deliver(self, message: dict[str, Any]) -> None:
+        if self.args.mode == "polling":
+            self.api.push_update(message)
+            return
+        assert self.session is not None
+        update = self.api.update(message)
+        headers = {}
+        if os.getenv("WEBHOOK_SECRET"):
+            headers["X-Telegram-Bot-Api-Secret-Token"] = os.environ["WEBHOOK_SECRET"]
+        while True:
+            async with self.session.post(self.bot_url, json=update, headers=headers) as r:
+                if r.status != 503:
+                    r.raise_for_status()
+                    return
+            # Как Telegram: очередь бота полна — повторяем позже
+            self.stats.deferred += 1
+            await asyncio.sleep(0.5)
+
+    async def _step(self, chat_id: int, step: str, message: dict[str, Any]) -> bool:
+        queue = self.replies[chat_id]
+        while not queue.empty():  # ответы на прошлый, не дождавшийся шаг
+            queue.get_nowait()
+        t0 = time.perf_counter()
+        await self._deliver(message)
+        self.stats.updates += 1
+        deadline = t0 + self.args.timeout
+        try:
+            while True:
+                method, params = await asyncio.wait_for(queue.get(), deadline - time.perf_counter())
+                if method == "sendMessage":
+                    break
+        except asyncio.TimeoutError:
+            self.stats.failed[f"{step}_timeout"] += 1
+            return False
+        self.stats.latency[step].append(time.perf_counter() - t0)
+        if step == "views" and "/v/" not in params.get("text", ""):
+            # Бот ответил отказом («много запросов», «не успел» …)
+            self.stats.failed["views_rejected"] += 1
+            return False
+        return True
+
+    async def _flow(self, chat_id: int, n: int) -> None:
+        api = self.api
+        photo = {"photo": [self.photos[chat_id]]}
+        steps = (
+            ("photo", api.message(chat_id, **photo)),
+            ("caption", api.message(chat_id, text=f"@user{chat_id} #{n}")),
+            ("views", api.message(chat_id, text="3")),
+        )
+        for step, message in steps:
+            if not await self._step(chat_id, step, message):
+                return
+            if self.args.think:
+                await asyncio.sleep(self.args.think)
+        self.stats.flows += 1
+
+    async def _user(self, chat_id: int, starts: asyncio.Queue[int]) -> None:
+        while True:
+            n = await starts.get()
+            try:
+                await self._flow(chat_id, n)
+            finally:
+                starts.task_done()
+
+    async def run_stage(self, rate: float, seconds: float) -> dict[str, Any]:
+        self.stats = Stats()
+        probe = LagProbe()
+        probe_task = asyncio.create_task(probe.run())
+        starts: asyncio.Queue[int] = asyncio.Queue()
+        users = []
+        for chat_id in self._chat_ids():
+            self.replies[chat_id] = asyncio.Queue()
+            users.append(asyncio.create_task(self._user(chat_id, starts)))
+
+        wall_start = time.time()
+        t_start = time.perf_counter()
+        offered = 0
+        while (elapsed := time.perf_counter() - t_start) < seconds:
+            due = int(elapsed * rate) + 1
+            while offered < due:
+                starts.put_nowait(offered)
+                offered += 1
+            await asyncio.sleep(min(1 / rate, 0.05))
+        late = starts.qsize()
+        # Не начатые вовремя диалоги не запускаем — дожидаемся только уже идущих
+        while not starts.empty():
+            starts.get_nowait()
+            starts.task_done()
+        await starts.join()
+        took = time.perf_counter() - t_start
+        for task in (*users, probe_task):
+            task.cancel()
+        await asyncio.gather(*users, probe_task, return_exceptions=True)
+
+        result = self.stats.report(took)
+        result.update(
+            rate=rate,
+            offered=offered,
+            late_starts=late,
+            seconds=took,
+            bot_lag=_lag_report(_read_lag(self.args.lag_path, wall_start, time.time())),
+            driver_lag=_lag_report(probe.window(wall_start, time.time())),
+        )
+        return result
+
+
+# --- запуск ---
+
+
+def _bot_env(args: argparse.Namespace, api_url: str, storage: str, port: int) -> dict[str, str]:
+    env = dict(os.environ, BOT_TOKEN=TOKEN, TELEGRAM_API_URL=api_url, STORAGE_DIR=storage)
+    # Ограничение частоты на чат мешает меряться; можно вернуть, задав явно
+    env.setdefault("RATE_LIMIT_PER_MIN", "0")
+    env.pop("WEBHOOK_URL", None)
+    if args.mode != "polling":
+        env["WEBHOOK_PORT"] = str(port)
+    if args.mode == "webhook":
+        env["WEBHOOK_URL"] = f"http://127.0.0.1:{port}/webhook"
+        env["WEBHOOK_HOST"] = "127.0.0.1"
+    return env
+
+
+async def _wait_ready(api: FakeBotAPI, args: argparse.Namespace, proc: subprocess.Popen) -> None:
+    deadline = time.monotonic() + 60
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            if proc.poll() is not None:
+                raise RuntimeError(f"bot exited with code {proc.returncode}")
+            if args.mode == "polling":
+                if api.calls["getUpdates"]:
+                    return
+            else:
+                url = args.bot_url.rsplit("/", 1)[0] + "/"
+                try:
+                    async with session.get(url) as r:
+                        ready = args.mode == "webhook" or (await r.json())["status"] == "ready"
+                        if ready and (args.mode == "flask" or api.calls["setWebhook"]):
+                            return
+                except (aiohttp.ClientError, ValueError):
+                    pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError("bot did not start")
+
+
+def _print_stage(res: dict[str, Any]) -> None:
+    steps = res["steps"]
+    print(
+        f"rate {res['rate']:>6.1f}/s  flows {res['flows']:>5}/{res['offered']:<5} "
+        f"late {res['late_starts']:>4}  upd/s {res['updates_per_s']:7.1f}  "
+        f"failed {sum(res['failed'].values()):>4}  deferred {res['deferred']:>4}"
+    )
+    for step in STEPS:
+        s = steps[step]
+        print(
+            f"    {step:<8} p50 {s['p50_ms']:8.1f}  p90 {s['p90_ms']:8.1f}  "
+            f"p99 {s['p99_ms']:8.1f}  max {s['max_ms']:8.1f} ms"
+        )
+    for name in ("bot_lag", "driver_lag"):
+        lag = res[name]
+        print(
+            f"    {name:<10} p50 {lag['p50_ms']:6.1f}  p99 {lag['p99_ms']:6.1f}  "
+            f"max {lag['max_ms']:6.1f} ms"
+        )
+
+
+async def run(args: argparse.Namespace) -> list[dict[str, Any]]:
+    api = FakeBotAPI(latency=args.api_latency_ms / 1000)
+    api_port = _free_port()
+    runner = await api.start("127.0.0.1", api_port)
+    bot_port = _free_port()
+    args.bot_url = f"http://127.0.0.1:{bot_port}/webhook"
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        args.lag_path = Path(tmp) / "lag.txt"
+        env = _bot_env(args, f"http://127.0.0.1:{api_port}", tmp, bot_port)
+        cmd = [sys.executable, "-m", "bench.e2e_load", "--bot-child", args.mode, str(args.lag_path)]
+        log = None if args.bot_log else subprocess.DEVNULL
+        # Своя группа процессов: в конце убираем и воркеры пула рендера
+        proc = subprocess.Popen(cmd, env=env, stdout=log, stderr=log, start_new_session=True)
+        try:
+            await _wait_ready(api, args, proc)
+            driver = LoadDriver(api, args, args.bot_url)
+            async with aiohttp.ClientSession() as driver.session:
+                for rate in args.rates:
+                    res = await driver.run_stage(rate, args.seconds)
+                    _print_stage(res)
+                    results.append(res)
+        finally:
+            proc.terminate()
+            try:
+                await asyncio.to_thread(proc.wait, 15)
+            except subprocess.TimeoutExpired:
+                pass
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            proc.wait()
+            await runner.cleanup()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=("polling", "webhook", "flask"), default="polling")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--rates", default="1,2,5", help="диалогов в секунду, через запятую")
+    parser.add_argument("--seconds", type=float, default=20.0, help="длительность каждой ступени")
+    parser.add_argument("--think", type=float, default=0.0, help="пауза между шагами, с")
+    parser.add_argument("--timeout", type=float, default=60.0, help="ожидание ответа на шаг, с")
+    parser.add_argument("--image", default="jpeg_2mp", choices=[s.name for s in IMAGES])
+    parser.add_argument("--api-latency-ms", type=float, default=0.0)
+    parser.add_argument("--bot-log", action="store_true", help="не скрывать вывод бота")
+    parser.add_argument("--out", type=Path)
+    parser.add_argument("--bot-child", nargs=2, metavar=("MODE", "LAG_PATH"))
+    args = parser.parse_args()
+    if args.bot_child:
+        _bot_child(*args.bot_child)
+        return
+
+    args.rates = [float(r) for r in args.rates.split(",")]
+    print(f"mode {args.mode}, {args.users} users, image {args.image}")
+    results = asyncio.run(run(args))
+    if args.out:
+        meta = {"mode": args.mode, "users": args.users, "image": args.image}
+        args.out.write_text(json.dumps({"meta": meta, "stages": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""Локальная замена Telegram Bot API для нагрузочных прогонов.
+
+Отвечает на методы, которыми пользуется бот: ``getMe``, ``getUpdates`` (long
+polling из очереди, которую наполняет тест), ``getFile`` и скачивание файла,
+``sendMessage``, ``sendPhoto``, ``sendMediaGroup``; на остальные — ``true``.
+Ответы бота (``send*``) передаются в ``on_reply``, так тест узнаёт, что шаг
+диалога завершён. ``latency`` добавляет задержку к каждому вызову — как
+сетевой путь до настоящего Telegram.
+
+Бот подключается через ``TELEGRAM_API_URL=http://127.0.0.1:<port>``.
+Отдельно: ``python -m bench.fake_telegram [--port 8090] [--latency-ms 0]``;
+апдейты можно положить через ``POST /_updates`` (JSON сообщения), файл —
+через ``POST /_files`` (в ответ — ``PhotoSize`` для сообщения).
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import logging
+from collections import Counter
+from typing import Any, Callable, Optional
+
+from aiohttp import web
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# chat_id, метод, параметры вызова
+ReplyHook = Callable[[int, str, dict[str, Any]], None]
+
+
+class FakeBotAPI:
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        self.files: dict[str, bytes] = {}
+        self.calls: Counter[str] = Counter()
+        self.uploaded_bytes = 0
+        self.on_reply: Optional[ReplyHook] = None
+        self._updates: list[dict[str, Any]] = []
+        self._new_update = asyncio.Event()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+
+    # --- со стороны теста ---
+
+    def add_file(self, content: bytes, width: int, height: int) -> dict[str, Any]:
+        """Регистрирует файл для ``getFile`` и возвращает ``PhotoSize`` для апдейта."""
+        n = next(self._file_ids)
+        file_id = f"photo{n}"
+        self.files[file_id] = content
+        return {
+            "file_id": file_id,
+            "file_unique_id": f"u{n}",
+            "width": width,
+            "height": height,
+            "file_size": len(content),
+        }
+
+    def message(self, chat_id: int, **fields: Any) -> dict[str, Any]:
+        """Входящее сообщение от пользователя ``chat_id``."""
+        return {
+            "message_id": next(self._message_ids),
+            "date": 0,
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"},
+            **fields,
+        }
+
+    def update(self, message: dict[str, Any]) -> dict[str, Any]:
+        return {"update_id": next(self._update_ids), "message": message}
+
+    def push_update(self, message: dict[str, Any]) -> None:
+        """Кладёт апдейт в очередь, которую забирает ``getUpdates``."""
+        self._updates.append(self.update(message))
+        self._new_update.set()
+
+    # --- Bot API ---
+
+    async def _params(self, request: web.Request) -> dict[str, Any]:
+        if request.content_type.startswith("multipart/"):
+            params: dict[str, Any] = {}
+            async for part in await request.multipart():
+                if part.filename:  # type: ignore[union-attr]
+                    content = await part.read()  # type: ignore[union-attr]
+                    self.uploaded_bytes += len(content)
+                else:
+                    params[part.name] = await part.text()  # type: ignore[union-attr]
+            return params
+        if request.content_type == "application/json":
+            return await request.json()
+        return dict(await request.post())
+
+    async def _get_updates(self, params: dict[str, Any]) -> list[dict[str, Any]]:
+        offset = int(params.get("offset") or 0)
+        if offset:
+            # Подтверждённые ботом апдейты больше не нужны
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates:
+            self._new_update.clear()
+            try:
+                await asyncio.wait_for(self._new_update.wait(), float(params.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[: int(params.get("limit") or 100)]
+
+    def _sent(self, chat_id: int, **fields: Any) -> dict[str, Any]:
+        return {
+            "message_id": next(self._message_ids),
+            "date": 0,
+            "chat": {"id": chat_id, "type": "private"},
+            **fields,
+        }
+
+    def _sent_photo(self, chat_id: int) -> dict[str, Any]:
+        n = next(self._file_ids)
+        size = {"file_id": f"sent{n}", "file_unique_id": f"s{n}", "width": 1, "height": 1}
+        return self._sent(chat_id, photo=[size])
+
+    async def _method(self, request: web.Request) -> web.Response:
+        name = request.match_info["method"]
+        params = await self._params(request)
+        self.calls[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        result: Any = True
+        chat_id = int(params.get("chat_id") or 0)
+        if name == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+        elif name == "getUpdates":
+            result = await self._get_updates(params)
+        elif name == "getFile":
+            file_id = params["file_id"]
+            if file_id not in self.files:
+                return web.json_response(
+                    {"ok": False, "error_code": 400, "description": "Bad Request: invalid file_id"}
+                )
+            result = {
+                "file_id": file_id,
+                "file_unique_id": "u" + file_id,
+                "file_size": len(self.files[file_id]),
+                "file_path": f"photos/{file_id}.jpg",
+            }
+        elif name == "sendMessage":
+            result = self._sent(chat_id, text=params.get("text", ""))
+        elif name == "sendPhoto":
+            result = self._sent_photo(chat_id)
+        elif name == "sendMediaGroup":
+            result = [self._sent_photo(chat_id) for _ in json.loads(params["media"])]
+
+        if name.startswith("send") and self.on_reply is not None:
+            self.on_reply(chat_id, name, params)
+        return web.json_response({"ok": True, "result": result})
+
+    async def _file(self, request: web.Request) -> web.Response:
+        file_id = request.match_info["path"].rsplit("/", 1)[-1].split(".", 1)[0]
+        content = self.files.get(file_id)
+        if content is None:
+            raise web.HTTPNotFound()
+        return web.Response(body=content, content_type="image/jpeg")
+
+    # --- ручной режим ---
+
+    async def _push(self, request: web.Request) -> web.Response:
+        self.push_update(await request.json())
+        return web.json_response({"ok": True})
+
+    async def _upload(self, request: web.Request) -> web.Response:
+        content = await request.read()
+        with Image.open(io.BytesIO(content)) as im:
+            width, height = im.size
+        return web.json_response(self.add_file(content, width, height))
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_get("/file/bot{token}/{path:.+}", self._file)
+        app.router.add_route("*", "/bot{token}/{method}", self._method)
+        app.router.add_post("/_updates", self._push)
+        app.router.add_post("/_files", self._upload)
+        return app
+
+    async def start(self, host: str, port: int) -> web.AppRunner:
+        runner = web.AppRunner(self.app(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    api = FakeBotAPI(latency=args.latency_ms / 1000)
+    api.on_reply = lambda chat_id, name, params: logger.info(
+        "%s -> %s %s", name, chat_id, params.get("text", "")[:80]
+    )
+    logger.info("TELEGRAM_API_URL=http://%s:%d", args.host, args.port)
+    web.run_app(api.app(), host=args.host, port=args.port, access_log=None, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""Нагрузочный тест ``/v/<token>``: Flask-сервер против asyncio-сервера.
+
+Каждый сервер запускается отдельным процессом на временном хранилище
+(``STORAGE_DIR``), затем ``--concurrency`` клиентов без пауз запрашивают случайные
+ссылки в течение ``--seconds`` секунд. Печатаются запросы в секунду и задержки
+p50/p99. С ``--slow`` каждый клиент читает ответ мелкими порциями с паузами,
+имитируя медленный мобильный канал.
+
+Запуск: ``python -m bench.link_load [--concurrency 200] [--seconds 10] [--slow]``.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import io
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import aiohttp
+from PIL import Image
+
+from bench.links import use_temp_storage
+from bot import links
+
+SERVERS = {
+    "flask": [sys.executable, "-m", "bot.link_server"],
+    "asyncio": [sys.executable, "-m", "bot.link_server_async"],
+}
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _sample_jpeg() -> bytes:
+    out = io.BytesIO()
+    Image.linear_gradient("L").resize((1280, 960)).convert("RGB").save(out, "JPEG", quality=85)
+    return out.getvalue()
+
+
+async def _wait_ready(base: str) -> None:
+    async with aiohttp.ClientSession() as session:
+        for _ in range(100):
+            try:
+                async with session.get(base + "/") as r:
+                    if r.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"server at {base} did not start")
+
+
+async def _client(
+    session: aiohttp.ClientSession,
+    base: str,
+    tokens: list[str],
+    deadline: float,
+    slow: bool,
+    latencies: list[float],
+    errors: list[int],
+) -> None:
+    while time.perf_counter() < deadline:
+        t0 = time.perf_counter()
+        try:
+            async with session.get(f"{base}/v/{random.choice(tokens)}") as r:
+                if slow:
+                    async for _ in r.content.iter_chunked(16 * 1024):
+                        await asyncio.sleep(0.01)
+                else:
+                    await r.read()
+                if r.status != 200:
+                    errors.append(r.status)
+        except aiohttp.ClientError:
+            errors.append(0)
+        latencies.append(time.perf_counter() - t0)
+
+
+async def _load(base: str, tokens: list[str], args: argparse.Namespace) -> dict[str, float]:
+    latencies: list[float] = []
+    errors: list[int] = []
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        deadline = time.perf_counter() + args.seconds
+        await asyncio.gather(
+            *(
+                _client(session, base, tokens, deadline, args.slow, latencies, errors)
+                for _ in range(args.concurrency)
+            )
+        )
+    latencies.sort()
+    n = len(latencies)
+    return {
+        "requests": n,
+        "rps": n / args.seconds,
+        "p50_ms": latencies[n // 2] * 1000 if n else 0.0,
+        "p99_ms": latencies[min(n - 1, int(n * 0.99))] * 1000 if n else 0.0,
+        "errors": len(errors),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--links", type=int, default=50)
+    parser.add_argument("--slow", action="store_true")
+    parser.add_argument("--servers", default=",".join(SERVERS))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        use_temp_storage(Path(tmp))
+        content = _sample_jpeg()
+        tokens = [links.create_link(content, 10**9).token for _ in range(args.links)]
+
+        print(f"{'server':<8} {'req/s':>8} {'p50, ms':>8} {'p99, ms':>8} {'errors':>7}")
+        for name in args.servers.split(","):
+            port = _free_port()
+            env = dict(os.environ, STORAGE_DIR=tmp, LINK_SERVER_PORT=str(port), LINK_VARIANTS="")
+            proc = subprocess.Popen(
+                SERVERS[name], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+            try:
+                base = f"http://127.0.0.1:{port}"
+                asyncio.run(_wait_ready(base))
+                res = asyncio.run(_load(base, tokens, args))
+            finally:
+                proc.terminate()
+                proc.wait()
+            print(
+                f"{name:<8} {res['rps']:8.0f} {res['p50_ms']:8.1f} "
+                f"{res['p99_ms']:8.1f} {res['errors']:7d}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Пропускная способность ``consume_view``/``create_link`` на временной БД.
+
+Запуск: ``python -m bench.links [--threads N] [--seconds S]``. Отдельно меряется
+режим «новый поток на запрос», как у Flask-сервера ссылок (werkzeug threaded).
+"""
+
+from __future__ import annotations
+
+import argparse
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from bot import links
+
+
+def use_temp_storage(root: Path) -> None:
+    """Перенаправляет ``bot.links`` во временный каталог (до первого обращения к БД)."""
+    links.DATA_DIR = root
+    links.DB_PATH = root / "links.db"
+    links.FILES_DIR = root / "files"
+
+
+def bench_consume(tokens: list[str], threads: int, seconds: float) -> float:
+    done = [0] * threads
+    deadline = time.perf_counter() + seconds
+
+    def worker(i: int) -> None:
+        n = 0
+        while time.perf_counter() < deadline:
+            links.consume_view(tokens[n % len(tokens)])
+            n += 1
+        done[i] = n
+
+    pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    return sum(done) / seconds
+
+
+def bench_consume_fresh_threads(tokens: list[str], seconds: float) -> float:
+    """Каждый ``consume_view`` — в новом потоке, как запрос к werkzeug."""
+    n = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        t = threading.Thread(target=links.consume_view, args=(tokens[n % len(tokens)],))
+        t.start()
+        t.join()
+        n += 1
+    return n / seconds
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=3.0)
+    parser.add_argument("--links", type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        use_temp_storage(Path(tmp))
+        t0 = time.perf_counter()
+        tokens = [links.create_link(b"x", 10**9).token for _ in range(args.links)]
+        create_rps = args.links / (time.perf_counter() - t0)
+        print(f"create_link:              {create_rps:10.0f} req/s")
+        for threads in sorted({1, args.threads}):
+            rps = bench_consume(tokens, threads, args.seconds)
+            print(f"consume_view, {threads} thread(s): {rps:10.0f} req/s")
+        rps = bench_consume_fresh_threads(tokens, args.seconds)
+        print(f"consume_view, thread/call:  {rps:10.0f} req/s")
+
+
+if __name__ == "__main__":
+    main()
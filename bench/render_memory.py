@@ -0,0 +1,79 @@
+"""Пиковый RSS одного рендера для каждого рендерера ``bot.image_utils``.
+
+Каждый замер идёт в отдельном процессе: входной JPEG читается с диска, после
+импорта модулей фиксируется ``ru_maxrss``, затем выполняется один рендер.
+Разница — прирост пика памяти на рендер.
+
+Запуск: ``python -m bench.render_memory [--max-edge N]`` (0 — без ограничения).
+"""
+
+from __future__ import annotations
+
+import argparse
+import inspect
+import io
+import json
+import resource
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+from PIL import Image
+
+SIZES = {"4MP": (2304, 1728), "12MP": (4000, 3000), "24MP": (6000, 4000)}
+RENDERERS = ("render_watermark_tiled", "render_watermark_center", "render_text_on_image_bottom")
+TEXT = "@watermark sample"
+
+
+def _make_jpeg(path: Path, size: tuple[int, int]) -> None:
+    w, h = size
+    # Градиент, а не сплошная заливка, чтобы JPEG был похож на фото по размеру
+    im = Image.linear_gradient("L").resize((w, h)).convert("RGB")
+    im.save(path, format="JPEG", quality=90)
+
+
+def _child(renderer: str, path: str, max_edge: int | None) -> None:
+    from bot import image_utils
+
+    fn = getattr(image_utils, renderer)
+    raw = Path(path).read_bytes()
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    kwargs = {}
+    if max_edge is not None and "max_edge" in inspect.signature(fn).parameters:
+        kwargs["max_edge"] = max_edge
+    out = fn(raw, TEXT, **kwargs)
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with Image.open(io.BytesIO(out)) as im:
+        out_size = im.size
+    # ru_maxrss в Linux — в килобайтах
+    print(json.dumps({"delta_kb": after - before, "peak_kb": after, "out": out_size}))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max-edge", type=int, default=None)
+    parser.add_argument("--child", nargs=2, metavar=("RENDERER", "PATH"))
+    args = parser.parse_args()
+    if args.child:
+        _child(args.child[0], args.child[1], args.max_edge)
+        return
+
+    print(f"{'renderer':<28} {'size':>5} {'peak, MB':>9} {'per render, MB':>15} {'output':>11}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, size in SIZES.items():
+            path = Path(tmp) / f"{name}.jpg"
+            _make_jpeg(path, size)
+            for renderer in RENDERERS:
+                cmd = [sys.executable, "-m", "bench.render_memory", "--child", renderer, str(path)]
+                if args.max_edge is not None:
+                    cmd += ["--max-edge", str(args.max_edge)]
+                res = json.loads(subprocess.check_output(cmd))
+                print(
+                    f"{renderer:<28} {name:>5} {res['peak_kb'] / 1024:9.1f} "
+                    f"{res['delta_kb'] / 1024:15.1f} {'x'.join(map(str, res['out'])):>11}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+"""Сводный бенчмарк горячих путей: рендереры, ``create_link``/``consume_view`` и ``/v/<token>``.
+
+Для каждого рендерера ``bot.image_utils`` на корпусе из :mod:`bench.corpus`
+меряются задержка (первый вызов с пустыми кэшами и медиана повторных),
+пропускная способность в мегапикселях в секунду и пиковый RSS (в отдельном
+процессе на каждый кадр). Затем — операции с БД ссылок и HTTP-отдача файла
+asyncio-сервером.
+
+Результаты пишутся в JSON (``--out``). С ``--baseline`` прошлый JSON
+сравнивается с текущим: метрики, ухудшившиеся больше чем на ``--threshold``,
+печатаются, и код выхода становится 1.
+
+Запуск: ``python -m bench.suite [--quick] [--out bench.json] [--baseline old.json]``.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable
+
+import PIL
+
+from bench.corpus import CAPTIONS, IMAGES, QUICK_IMAGES, Sample, make_image
+from bench.links import bench_consume, use_temp_storage
+from bot import image_utils, links
+
+RENDERERS = ("render_watermark_tiled", "render_watermark_center", "render_text_on_image_bottom")
+
+# Метрика → что лучше. По суффиксу имени: *_ms и *_mb — меньше, *_per_s — больше.
+Results = dict[str, float]
+
+
+def _lower_is_better(name: str) -> bool:
+    return not name.endswith("_per_s")
+
+
+def _clear_caches() -> None:
+    image_utils._tile_cache.clear()
+    image_utils._layer_cache.clear()
+
+
+def _timed(fn: Callable[[], Any], repeat: int) -> tuple[float, list[float]]:
+    """Первый вызов (с пустыми кэшами) и времена повторных, в секундах."""
+    _clear_caches()
+    t0 = time.perf_counter()
+    fn()
+    cold = time.perf_counter() - t0
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return cold, times
+
+
+def bench_renderers(samples: tuple[Sample, ...], repeat: int) -> Results:
+    results: Results = {}
+    corpus = {s.name: make_image(s) for s in samples}
+    for renderer in RENDERERS:
+        fn = getattr(image_utils, renderer)
+        for sample in samples:
+            raw = corpus[sample.name]
+            # Все кадры с одной подписью, все подписи на одном кадре среднего размера
+            captions = CAPTIONS if sample.name == "jpeg_2mp" else {"latin": CAPTIONS["latin"]}
+            for label, text in captions.items():
+                cold, times = _timed(lambda: fn(raw, text), repeat)
+                warm = statistics.median(times)
+                key = f"render.{renderer}.{sample.name}.{label}"
+                results[f"{key}.cold_ms"] = cold * 1000
+                results[f"{key}.p50_ms"] = warm * 1000
+                results[f"{key}.mpix_per_s"] = sample.megapixels / warm
+    return results
+
+
+def _peak_rss_kb() -> int:
+    # ru_maxrss после exec наследует пик родителя (а родитель уже рендерил большие
+    # кадры), VmHWM — пик именно этого процесса
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _rss_child(renderer: str, path: str) -> None:
+    fn = getattr(image_utils, renderer)
+    raw = Path(path).read_bytes()
+    before = _peak_rss_kb()
+    fn(raw, CAPTIONS["latin"])
+    after = _peak_rss_kb()
+    print(json.dumps({"peak_mb": after / 1024, "delta_mb": (after - before) / 1024}))
+
+
+def bench_rss(samples: tuple[Sample, ...], tmp: Path) -> Results:
+    results: Results = {}
+    for sample in samples:
+        path = tmp / f"{sample.name}.{sample.format.lower()}"
+        path.write_bytes(make_image(sample))
+        for renderer in RENDERERS:
+            cmd = [sys.executable, "-m", "bench.suite", "--rss-child", renderer, str(path)]
+            res = json.loads(subprocess.check_output(cmd))
+            results[f"rss.{renderer}.{sample.name}.delta_mb"] = res["delta_mb"]
+            results[f"rss.{renderer}.{sample.name}.peak_mb"] = res["peak_mb"]
+    return results
+
+
+def bench_links(tmp: Path, seconds: float) -> Results:
+    use_temp_storage(tmp)
+    # Каждая ссылка — отдельный файл в хранилище, поэтому берём самый мелкий кадр
+    content = make_image(IMAGES[0])
+    n = 300
+    t0 = time.perf_counter()
+    tokens = [links.create_link(content + i.to_bytes(4, "big"), 10**9).token for i in range(n)]
+    results: Results = {"links.create_link.ops_per_s": n / (time.perf_counter() - t0)}
+    for threads in (1, 4):
+        rps = bench_consume(tokens, threads, seconds)
+        results[f"links.consume_view.{threads}_threads.ops_per_s"] = rps
+    return results
+
+
+def bench_http(tmp: Path, seconds: float) -> Results:
+    # link_load импортирует aiohttp-клиент — только когда он действительно нужен
+    from bench.link_load import SERVERS, _free_port, _load, _wait_ready
+
+    tokens = [links.create_link(make_image(IMAGES[1]), 10**9).token for _ in range(20)]
+    results: Results = {}
+    port = _free_port()
+    env = dict(os.environ, STORAGE_DIR=str(tmp), LINK_SERVER_PORT=str(port), LINK_VARIANTS="")
+    proc = subprocess.Popen(
+        SERVERS["asyncio"], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        base = f"http://127.0.0.1:{port}"
+        asyncio.run(_wait_ready(base))
+        for concurrency in (1, 50):
+            opts = argparse.Namespace(concurrency=concurrency, seconds=seconds, slow=False)
+            res = asyncio.run(_load(base, tokens, opts))
+            key = f"http.view.c{concurrency}"
+            results[f"{key}.req_per_s"] = res["rps"]
+            results[f"{key}.p50_ms"] = res["p50_ms"]
+            results[f"{key}.p99_ms"] = res["p99_ms"]
+    finally:
+        proc.terminate()
+        proc.wait()
+    return results
+
+
+def _meta() -> dict[str, Any]:
+    try:
+        rev = subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        rev = ""
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git": rev,
+        "python": platform.python_version(),
+        "pillow": PIL.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def compare(baseline: Results, current: Results, threshold: float) -> list[str]:
+    """Строки с метриками, ухудшившимися больше чем на ``threshold`` (доля)."""
+    regressions = []
+    for name, old in sorted(baseline.items()):
+        new = current.get(name)
+        if new is None or old <= 0:
+            continue
+        change = new / old - 1
+        worse = change > threshold if _lower_is_better(name) else change < -threshold
+        if worse:
+            regressions.append(f"{name}: {old:.2f} -> {new:.2f} ({change:+.0%})")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--quick", action="store_true", help="без кадров крупнее 5 Мп")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seconds", type=float, default=2.0)
+    parser.add_argument("--skip", default="", help="через запятую: render,rss,links,http")
+    parser.add_argument("--out", type=Path, default=Path("bench.json"))
+    parser.add_argument("--baseline", type=Path)
+    parser.add_argument("--threshold", type=float, default=0.15)
+    parser.add_argument("--rss-child", nargs=2, metavar=("RENDERER", "PATH"))
+    args = parser.parse_args()
+    if args.rss_child:
+        _rss_child(*args.rss_child)
+        return
+
+    skip = {s.strip() for s in args.skip.split(",") if s.strip()}
+    samples = QUICK_IMAGES if args.quick else IMAGES
+    results: Results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        if "render" not in skip:
+            results.update(bench_renderers(samples, args.repeat))
+        if "rss" not in skip:
+            results.update(bench_rss(samples, root))
+        if "links" not in skip or "http" not in skip:
+            results.update(bench_links(root / "links", args.seconds))
+        if "http" not in skip:
+            results.update(bench_http(root / "links", args.seconds))
+
+    for name, value in results.items():
+        print(f"{name:<72} {value:12.2f}")
+    args.out.write_text(
+        json.dumps({"meta": _meta(), "results": results}, indent=2, ensure_ascii=False)
+    )
+    print(f"\nwritten to {args.out}")
+
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text())["results"]
+        regressions = compare(baseline, results, args.threshold)
+        if regressions:
+            print(f"\nRegressions (>{args.threshold:.0%}):")
+            for line in regressions:
+                print("  " + line)
+            sys.exit(1)
+        print(f"\nNo regressions against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
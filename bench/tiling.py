@@ -0,0 +1,67 @@
+"""Микробенчмарк сборки плиточного слоя: старый цикл ``alpha_composite`` против
+периодической ячейки с заполнением удвоением.
+
+Запуск: ``python -m bench.tiling``. Печатает время на 1, 4 и 12 Мп и максимальное
+расхождение слоёв по каналам (ожидается 0: плитки не перекрываются, поэтому
+``paste`` и ``alpha_composite`` на прозрачный слой дают одинаковые пиксели).
+"""
+
+from __future__ import annotations
+
+import time
+
+from PIL import Image, ImageChops
+
+from bot.image_utils import _fill_periodic, _tiled_cell, _tiled_font, _tiled_tile
+
+SIZES = {"1MP": (1152, 864), "4MP": (2304, 1728), "12MP": (4000, 3000)}
+TEXT = "@watermark sample"
+
+
+def loop_layer(rotated: Image.Image, width: int, height: int) -> Image.Image:
+    """Эталон: прежняя реализация с двойным циклом."""
+    rw, rh = rotated.size
+    layer = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+    step_x, step_y = rw, rh
+    y, row = -rh, 0
+    while y < height + rh:
+        x = -rw + (step_x // 2 if row % 2 else 0)
+        while x < width + rw:
+            layer.alpha_composite(rotated, (x, y))
+            x += step_x
+        y += step_y
+        row += 1
+    return layer
+
+
+def periodic_layer(rotated: Image.Image, width: int, height: int) -> Image.Image:
+    rw, rh = rotated.size
+    return _fill_periodic(_tiled_cell(rotated, rw, rh), width, height)
+
+
+def _best_of(fn, *args, repeat: int = 5) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main() -> None:
+    print(f"{'size':>5} {'loop, ms':>10} {'periodic, ms':>13} {'speedup':>8} {'max diff':>9}")
+    for name, (w, h) in SIZES.items():
+        font_size = max(12, int(min(w, h) * 0.05))
+        rotated = _tiled_tile(TEXT, _tiled_font(font_size), font_size)
+        diff = ImageChops.difference(loop_layer(rotated, w, h), periodic_layer(rotated, w, h))
+        max_diff = max(hi for _, hi in diff.getextrema())
+        t_loop = _best_of(loop_layer, rotated, w, h)
+        t_new = _best_of(periodic_layer, rotated, w, h)
+        print(
+            f"{name:>5} {t_loop * 1000:10.1f} {t_new * 1000:13.1f} "
+            f"{t_loop / t_new:7.1f}x {max_diff:9d}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""Сборка альбомов из отдельных сообщений.
+
+Части альбома (``media_group_id``) приходят отдельными апдейтами почти
+одновременно; альбом считается собранным, если новых частей не было
+``ALBUM_DELAY`` секунд. Первая часть, пришедшая в процесс, запускает ``collect``,
+остальные только добавляются.
+
+С несколькими webhook-процессами части одного альбома попадают в разные
+процессы, поэтому при ``FSM_STORAGE=sqlite`` части складываются в общую таблицу
+SQLite: тишину каждый процесс проверяет по последней записи в ней, а забирает
+альбом тот, чей ``DELETE … RETURNING`` выполнится первым. Остальные получают
+``None`` и ничего не отвечают.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Optional, Protocol, TypeVar
+
+from .config import Settings
+from .links import DATA_DIR
+
+ALBUMS_DB_PATH = DATA_DIR / "albums.db"
+
+DEFAULT_DELAY = float(os.getenv("ALBUM_DELAY", "0.8"))
+
+T = TypeVar("T")
+
+# Собранный альбом: фото в порядке сообщений (``[file_id, file_size, file_unique_id]``)
+# и первая непустая подпись
+Album = tuple[list[list], str]
+
+
+class AlbumParts(Protocol):
+    async def add(self, group_id: str, message_id: int, photo: list, caption: str) -> bool:
+        """Добавляет часть; ``True`` — первая часть в этом процессе, пора запускать ``collect``."""
+        ...
+
+    async def collect(self, group_id: str) -> Optional[Album]:
+        """Ждёт, пока части перестанут приходить, и забирает альбом.
+
+        ``None`` — альбом уже забрал другой процесс.
+        """
+        ...
+
+    def close(self) -> None: ...
+
+
+def _assemble(parts: list[tuple[int, list, str]]) -> Album:
+    parts.sort(key=lambda part: part[0])
+    return [photo for _, photo, _ in parts], next((c for _, _, c in parts if c), "")
+
+
+class MemoryAlbums:
+    """Части альбомов в памяти процесса (один процесс бота)."""
+
+    def __init__(self, delay: float = DEFAULT_DELAY) -> None:
+        self.delay = delay
+        self._parts: dict[str, list[tuple[int, list, str]]] = {}
+
+    async def add(self, group_id: str, message_id: int, photo: list, caption: str) -> bool:
+        parts = self._parts.get(group_id)
+        if parts is not None:
+            parts.append((message_id, photo, caption))
+            return False
+        self._parts[group_id] = [(message_id, photo, caption)]
+        return True
+
+    async def collect(self, group_id: str) -> Optional[Album]:
+        parts = self._parts[group_id]
+        seen = 0
+        while seen != len(parts):
+            seen = len(parts)
+            await asyncio.sleep(self.delay)
+        del self._parts[group_id]
+        return _assemble(parts)
+
+    def close(self) -> None:
+        self._parts.clear()
+
+
+class SQLiteAlbums:
+    """Части альбомов в общей таблице SQLite — для нескольких процессов бота.
+
+    Как :class:`bot.fsm.SQLiteStorage`, все запросы идут в отдельном потоке БД, и
+    event loop не ждёт блокировку записи, за которую соревнуются процессы. Части,
+    которые никто не забрал (процесс упал), удаляются через ``stale`` секунд.
+    """
+
+    def __init__(
+        self, path: Path = ALBUMS_DB_PATH, delay: float = DEFAULT_DELAY, stale: float = 3600.0
+    ) -> None:
+        self.path = Path(path)
+        self.delay = delay
+        self.stale = stale
+        # Одна нить на соединение: sqlite3 не любит делить соединение между потоками
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="albums-sqlite")
+        self._db: Optional[sqlite3.Connection] = None
+        # Альбомы, для которых в этом процессе уже идёт collect
+        self._collecting: set[str] = set()
+
+    # --- операции в потоке БД ---
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS album_parts (
+                    group_id TEXT NOT NULL,
+                    message_id INTEGER NOT NULL,
+                    file_id TEXT NOT NULL,
+                    file_size INTEGER,
+                    file_unique_id TEXT NOT NULL,
+                    caption TEXT NOT NULL,
+                    received_at REAL NOT NULL,
+                    PRIMARY KEY (group_id, message_id)
+                ) WITHOUT ROWID
+                """
+            )
+            self._db = db
+        return self._db
+
+    def _insert(self, group_id: str, message_id: int, photo: list, caption: str) -> None:
+        file_id, file_size, file_unique_id = photo
+        self._connect().execute(
+            "INSERT OR REPLACE INTO album_parts VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (group_id, message_id, file_id, file_size, file_unique_id, caption, time.time()),
+        )
+
+    def _last_received(self, group_id: str) -> Optional[float]:
+        (last,) = (
+            self._connect()
+            .execute("SELECT MAX(received_at) FROM album_parts WHERE group_id = ?", (group_id,))
+            .fetchone()
+        )
+        return last
+
+    def _claim(self, group_id: str) -> list[tuple[int, str, Optional[int], str, str]]:
+        # Забирает тот, чей DELETE выполнится первым: он атомарен
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            rows = db.execute(
+                "DELETE FROM album_parts WHERE group_id = ? "
+                "RETURNING message_id, file_id, file_size, file_unique_id, caption",
+                (group_id,),
+            ).fetchall()
+            db.execute("DELETE FROM album_parts WHERE received_at < ?", (time.time() - self.stale,))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return rows
+
+    def _close_db(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    # --- асинхронная часть ---
+
+    async def _run(self, fn: Callable[..., T], *args: Any) -> T:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def add(self, group_id: str, message_id: int, photo: list, caption: str) -> bool:
+        await self._run(self._insert, group_id, message_id, photo, caption)
+        if group_id in self._collecting:
+            return False
+        self._collecting.add(group_id)
+        return True
+
+    async def collect(self, group_id: str) -> Optional[Album]:
+        try:
+            wait = self.delay
+            while wait > 0:
+                await asyncio.sleep(wait)
+                last = await self._run(self._last_received, group_id)
+                if last is None:
+                    return None  # забрал другой процесс
+                wait = last + self.delay - time.time()
+            rows = await self._run(self._claim, group_id)
+        finally:
+            self._collecting.discard(group_id)
+        if not rows:
+            return None
+        return _assemble([(m, [fid, size, uid], caption) for m, fid, size, uid, caption in rows])
+
+    def close(self) -> None:
+        self._executor.submit(self._close_db)
+        self._executor.shutdown(wait=True)
+
+
+def create_albums(settings: Settings) -> AlbumParts:
+    # Общее FSM-хранилище означает, что апдейты чата могут прийти в разные процессы
+    if settings.fsm_storage == "sqlite":
+        return SQLiteAlbums()
+    return MemoryAlbums()
@@ -11,7 +11,25 @@ from dotenv import load_dotenv
 @dataclass(frozen=True)
 class Settings:
     bot_token: str
+    api_url: str = ""
     webhook_url: str = ""
+    webhook_secret: str = ""
+    webhook_host: str = "0.0.0.0"
+    webhook_port: int = 8081
+    webhook_workers: int = 1
+    render_workers: int = 1
+    render_queue: int = 8
+    render_timeout: float = 60.0
+    fsm_ttl: float = 3600.0
+    fsm_storage: str = "memory"
+    rate_limit: float = 30.0
+    rate_burst: int = 10
+    max_inflight: int = 32
+    ingest_workers: int = 8
+    ingest_queue: int = 256
+    ingest_policy: str = "defer"
+    metrics_port: int = 0
+    prerender_ttl: float = 300.0
 
 
 def _try_load_env_from(path: Path) -> None:
@@ -20,6 +38,20 @@ def _try_load_env_from(path: Path) -> None:
         load_dotenv(env_path)
 
 
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, "").strip() or default)
+    except ValueError:
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, "").strip() or default)
+    except ValueError:
+        return default
+
+
 def load_settings() -> Settings:
     """Загружает конфигурацию из .env и окружения.
 
@@ -59,4 +91,28 @@ def load_settings() -> Settings:
     # Загружаем URL webhook (опционально)
     webhook_url = os.getenv("WEBHOOK_URL", "").strip()
 
-    return Settings(bot_token=token, webhook_url=webhook_url)
+    # Пул рендера: по умолчанию процесс на ядро и небольшая очередь сверху
+    render_workers = _env_int("RENDER_WORKERS", os.cpu_count() or 1)
+
+    return Settings(
+        bot_token=token,
+        api_url=os.getenv("TELEGRAM_API_URL", "").strip(),
+        webhook_url=webhook_url,
+        webhook_secret=os.getenv("WEBHOOK_SECRET", "").strip(),
+        webhook_host=os.getenv("WEBHOOK_HOST", "").strip() or "0.0.0.0",
+        webhook_port=_env_int("WEBHOOK_PORT", 8081),
+        webhook_workers=max(1, _env_int("WEBHOOK_WORKERS", 1)),
+        render_workers=render_workers,
+        render_queue=_env_int("RENDER_QUEUE_SIZE", render_workers * 2),
+        render_timeout=_env_float("RENDER_TIMEOUT", 60.0),
+        fsm_ttl=_env_float("FSM_TTL", 3600.0),
+        fsm_storage=os.getenv("FSM_STORAGE", "memory").strip().lower() or "memory",
+        rate_limit=_env_float("RATE_LIMIT_PER_MIN", 30.0),
+        rate_burst=_env_int("RATE_LIMIT_BURST", 10),
+        max_inflight=_env_int("MAX_INFLIGHT", 32),
+        ingest_workers=_env_int("INGEST_WORKERS", 8),
+        ingest_queue=_env_int("INGEST_QUEUE_SIZE", 256),
+        ingest_policy=os.getenv("INGEST_POLICY", "defer").strip().lower() or "defer",
+        metrics_port=_env_int("METRICS_PORT", 0),
+        prerender_ttl=_env_float("PRERENDER_TTL", 300.0),
+    )
@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+import io
+import os
+from typing import Optional
+
+from aiogram import Bot
+from PIL import Image
+
+from .metrics import span
+
+# Больше этого не скачиваем (MAX_DOWNLOAD_MB; Bot API и так отдаёт не больше 20 МБ)
+MAX_DOWNLOAD_BYTES = int(float(os.getenv("MAX_DOWNLOAD_MB", "20")) * 1024 * 1024)
+
+# Заголовок любого поддерживаемого формата помещается в первые байты файла; дальше
+# не ищем — каждая попытка заново открывает всё накопленное
+_HEADER_LIMIT = 1024 * 1024
+
+
+class DownloadRejected(ValueError):
+    """Файл не подходит: слишком большой, не картинка или слишком много пикселей."""
+
+
+class _ImageSink(io.RawIOBase):
+    """Приёмник для ``Bot.download``: копит байты в один буфер и по ходу загрузки
+    разбирает заголовок картинки.
+
+    Размеры изображения известны после первых килобайт, поэтому «бомба»
+    по пикселям или не-картинка отклоняются, не дожидаясь конца загрузки.
+    Пиксели здесь не декодируются (``ImageFile.Parser`` сразу выделил бы под них
+    память) — это делает рендер в своём процессе.
+    """
+
+    def __init__(self, max_bytes: int, expected: Optional[int] = None) -> None:
+        self.max_bytes = max_bytes
+        # Известный размер — выделяем буфер один раз, без переаллокаций по мере роста
+        self.buffer = bytearray(expected or 0)
+        self.size = 0
+        self.header_ok = False
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, chunk: bytes) -> int:  # type: ignore[override]
+        end = self.size + len(chunk)
+        if end > self.max_bytes:
+            raise DownloadRejected("file is too large")
+        self.buffer[self.size : end] = chunk
+        self.size = end
+        if not self.header_ok:
+            self._check_header()
+        return len(chunk)
+
+    def _check_header(self) -> None:
+        try:
+            # open читает только заголовок; проверку на «бомбу» Pillow делает сам
+            with Image.open(io.BytesIO(self.buffer[: self.size])):
+                self.header_ok = True
+        except Image.DecompressionBombError as e:
+            raise DownloadRejected("image has too many pixels") from e
+        except OSError:
+            if self.size >= _HEADER_LIMIT:
+                raise DownloadRejected("not an image") from None
+
+    def getvalue(self) -> bytearray:
+        if not self.header_ok:
+            raise DownloadRejected("not an image")
+        del self.buffer[self.size :]
+        return self.buffer
+
+
+async def download_image(
+    bot: Bot,
+    file_id: str,
+    file_size: Optional[int] = None,
+    max_bytes: int = MAX_DOWNLOAD_BYTES,
+) -> bytearray:
+    """Скачивает картинку потоком в один буфер и возвращает его.
+
+    ``file_size`` (из ``PhotoSize``) позволяет отказать ещё до запроса к Telegram.
+    Бросает :class:`DownloadRejected`, если файл не подходит.
+    """
+    if file_size is not None and file_size > max_bytes:
+        raise DownloadRejected("file is too large")
+    sink = _ImageSink(max_bytes, expected=file_size)
+    with span("download"):
+        await bot.download(file_id, destination=sink, seek=False)
+    return sink.getvalue()
@@ -0,0 +1,151 @@
+from __future__ import annotations
+
+import io
+import os
+import secrets
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Iterable, Optional, Union
+
+from PIL import Image, features
+
+from .metrics import span
+
+
+@dataclass(frozen=True)
+class EncoderProfile:
+    """Набор параметров кодирования результата.
+
+    ``optimize`` — второй проход Хаффмана для JPEG: файл чуть меньше, кодирование
+    заметно медленнее. ``speed`` и ``method`` используются только AVIF и WebP.
+    """
+
+    name: str
+    format: str = "JPEG"
+    quality: int = 85
+    optimize: bool = False
+    progressive: bool = False
+    subsampling: Optional[str] = None
+    method: Optional[int] = None
+    speed: Optional[int] = None
+
+    @property
+    def extension(self) -> str:
+        return {"JPEG": ".jpg", "WEBP": ".webp", "AVIF": ".avif"}[self.format]
+
+    @property
+    def mimetype(self) -> str:
+        return {"JPEG": "image/jpeg", "WEBP": "image/webp", "AVIF": "image/avif"}[self.format]
+
+    @property
+    def available(self) -> bool:
+        return self.format == "JPEG" or bool(features.check(self.format.lower()))
+
+    def save_kwargs(self) -> dict[str, Any]:
+        kwargs: dict[str, Any] = {"format": self.format, "quality": self.quality}
+        if self.format == "JPEG":
+            kwargs["optimize"] = self.optimize
+            kwargs["progressive"] = self.progressive
+            if self.subsampling:
+                kwargs["subsampling"] = self.subsampling
+        if self.method is not None:
+            kwargs["method"] = self.method
+        if self.speed is not None:
+            kwargs["speed"] = self.speed
+        return kwargs
+
+
+PROFILES: dict[str, EncoderProfile] = {
+    # Для ответа в Telegram: Telegram всё равно пережимает фото
+    "fast": EncoderProfile("fast", quality=80, subsampling="4:2:0"),
+    "balanced": EncoderProfile("balanced", quality=85, subsampling="4:2:0"),
+    # Прежние параметры: максимум качества, самый медленный и крупный файл
+    "archival": EncoderProfile("archival", quality=95, optimize=True),
+    # Варианты для просмотра по ссылке в браузере
+    "webp": EncoderProfile("webp", format="WEBP", quality=80, method=4),
+    "avif": EncoderProfile("avif", format="AVIF", quality=60, speed=8),
+}
+
+DEFAULT_PROFILE = os.getenv("ENCODER_PROFILE", "balanced").strip() or "balanced"
+
+# Форматы, в которых ссылка может отдать картинку браузеру, в порядке предпочтения
+# (LINK_VARIANTS, например "avif,webp"). Пусто (по умолчанию) — всегда оригинал.
+LINK_VARIANTS = [
+    PROFILES[name.strip()]
+    for name in os.getenv("LINK_VARIANTS", "").split(",")
+    if name.strip() in PROFILES and PROFILES[name.strip()].format != "JPEG"
+]
+
+ProfileLike = Union[str, EncoderProfile, None]
+
+
+def get_profile(profile: ProfileLike = None) -> EncoderProfile:
+    """Профиль по имени; ``None`` — профиль развёртывания (``ENCODER_PROFILE``)."""
+    if isinstance(profile, EncoderProfile):
+        return profile
+    name = profile or DEFAULT_PROFILE
+    try:
+        return PROFILES[name]
+    except KeyError:
+        raise ValueError(f"Неизвестный профиль кодирования: {name}") from None
+
+
+def encode(image: Image.Image, profile: ProfileLike = None) -> bytes:
+    out = io.BytesIO()
+    with span("encode"):
+        image.save(out, **get_profile(profile).save_kwargs())
+    return out.getvalue()
+
+
+def negotiate(accept: str, candidates: Iterable[EncoderProfile]) -> Optional[EncoderProfile]:
+    """Первый из ``candidates``, чей MIME-тип явно указан в заголовке ``Accept``.
+
+    Подстановочные ``image/*`` и ``*/*`` не считаются: их шлют и браузеры,
+    которые не умеют AVIF/WebP.
+    """
+    accepted = set()
+    for part in accept.split(","):
+        mime, *params = (p.strip() for p in part.split(";"))
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            accepted.add(mime.lower())
+    for profile in candidates:
+        if profile.mimetype in accepted and profile.available:
+            return profile
+    return None
+
+
+def variant_path(path: Path, profile: EncoderProfile) -> Path:
+    return path.with_suffix(profile.extension)
+
+
+def write_variants(paths: Iterable[Path], profiles: Iterable[EncoderProfile]) -> None:
+    """Создаёт недостающие варианты файлов (задание для пула рендера).
+
+    Каждый файл декодируется один раз на все форматы.
+    """
+    available = [p for p in profiles if p.available]
+    for path in paths:
+        todo = [p for p in available if not variant_path(path, p).exists()]
+        if not todo:
+            continue
+        try:
+            with Image.open(path) as im:
+                rgb = im.convert("RGB")
+        except FileNotFoundError:
+            continue  # ссылку уже убрал сборщик
+        for profile in todo:
+            _write_file(variant_path(path, profile), encode(rgb, profile))
+
+
+def _write_file(target: Path, data: bytes) -> None:
+    tmp = target.with_name(f".{target.name}.{secrets.token_hex(4)}.tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, target)
@@ -3,23 +3,23 @@ from __future__ import annotations
 import asyncio
 import logging
 import threading
-from typing import Optional
+from typing import Any, Optional
 
 from aiogram import Bot, Dispatcher
-from aiogram.client.default import DefaultBotProperties
-from aiogram.enums import ParseMode
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import BotCommand, Update
 from flask import Flask, request
 
 from .config import load_settings
-from .main import router
+from .ingest import UpdateQueue
+from .main import _create_bot, create_dispatcher
+from .metrics import QUEUE_DEPTH, add_flask_routes, monitor_loop_lag
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
 logger = logging.getLogger(__name__)
 
 bot: Optional[Bot] = None
 dp: Optional[Dispatcher] = None
+updates: Optional[UpdateQueue] = None
 
 # Один общий event loop в отдельном потоке
 bg_loop = asyncio.new_event_loop()
@@ -35,12 +35,22 @@ threading.Thread(target=_loop_thread, name="aiogram-loop", daemon=True).start()
 
 
 async def _async_setup() -> None:
-    global bot, dp
+    global bot, dp, updates
     settings = load_settings()
 
-    bot = Bot(token=settings.bot_token, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-    dp = Dispatcher(storage=MemoryStorage())
-    dp.include_router(router)
+    bot = _create_bot(settings)
+    dp = create_dispatcher(settings)
+    # Апдейты идут через ограниченную очередь: всплеск фото не копит корутины в loop
+    updates = UpdateQueue(
+        lambda update: dp.feed_update(bot, update),
+        bg_loop,
+        workers=settings.ingest_workers,
+        max_size=settings.ingest_queue,
+        policy=settings.ingest_policy,
+    )
+
+    QUEUE_DEPTH.set_function(lambda: updates.stats()["depth"], queue="ingest")
+    asyncio.create_task(monitor_loop_lag())
 
     # локальная инициализация
     await dp.emit_startup(bot)
@@ -69,6 +79,7 @@ asyncio.run_coroutine_threadsafe(_async_setup(), bg_loop)
 
 def create_flask_app() -> Flask:
     app = Flask(__name__)
+    add_flask_routes(app)
 
     @app.get("/")
     def health() -> dict[str, str]:
@@ -77,10 +88,17 @@ def create_flask_app() -> Flask:
             "message": "Telegram Photo Caption Bot is running",
         }
 
+    @app.get("/stats")
+    def stats() -> dict[str, Any]:
+        return {
+            "ingest": updates.stats() if updates is not None else {},
+            "throttling": dp["throttling"].stats() if dp is not None else {},
+        }
+
     @app.post("/webhook")
     def webhook() -> tuple[str, int]:
         # Всегда быстрое 200 — Telegram не будет ждать 60 сек и ставить 499
-        if not _ready.is_set() or bot is None or dp is None:
+        if not _ready.is_set() or updates is None:
             logger.warning("Webhook hit while not ready")
             return "OK", 200
 
@@ -94,17 +112,12 @@ def create_flask_app() -> Flask:
             logger.exception("Update validation error: %s", e)
             return "OK", 200
 
-        try:
-            fut = asyncio.run_coroutine_threadsafe(dp.feed_update(bot, update), bg_loop)
-
-            def _cb(f) -> None:
-                exc = f.exception()
-                if exc:
-                    logger.exception("feed_update error: %s", exc)
-
-            fut.add_done_callback(_cb)
-        except Exception as e:
-            logger.exception("Scheduling error: %s", e)
+        if not updates.offer(update):
+            if updates.policy == "defer":
+                # Не 2xx — Telegram повторит доставку позже, апдейт не потеряется
+                logger.warning("Ingest queue is full, deferring update %s", update.update_id)
+                return "Busy", 503
+            logger.warning("Ingest queue is full, dropping update %s", update.update_id)
 
         return "OK", 200
 
@@ -0,0 +1,102 @@
+"""Шрифты и замеры текста, общие для всех рендереров процесса.
+
+Файл шрифта ищется один раз (``WATERMARK_FONT_PATH``, затем ``fonts/`` проекта,
+затем системные), объекты ``FreeTypeFont`` кэшируются по кеглю, а кегль
+округляется до ступени в ~4%: кадры близкого размера получают один и тот же
+объект шрифта и попадают в одни и те же кэши плиток и слоёв. Ширина строки
+и перенос по словам запоминаются по (текст, шрифт, ширина).
+"""
+
+from __future__ import annotations
+
+import os
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional
+
+from PIL import Image, ImageDraw, ImageFont
+
+Font = ImageFont.FreeTypeFont | ImageFont.ImageFont
+
+_HERE = Path(__file__).resolve().parent.parent
+
+# Имена без пути ищет сам FreeType/Pillow в системных каталогах шрифтов
+_CANDIDATES = (
+    _HERE / "fonts" / "NotoSans-Regular.ttf",
+    _HERE / "fonts" / "DejaVuSans.ttf",
+    Path("/usr/share/fonts/truetype/noto/NotoSans-Regular.ttf"),
+    Path("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"),
+    Path("/usr/share/fonts/truetype/freefont/FreeSans.ttf"),
+    "DejaVuSans.ttf",
+    "arial.ttf",
+)
+
+
+# Замеры — через ImageDraw, как раньше в рендерерах (многострочный текст тоже)
+_measure = ImageDraw.Draw(Image.new("RGBA", (1, 1)))
+
+
+@lru_cache(maxsize=1)
+def font_path() -> Optional[str]:
+    """Путь к первому загружаемому шрифту; ``None`` — только встроенный растровый."""
+    env_path = os.getenv("WATERMARK_FONT_PATH", "").strip()
+    for candidate in (env_path, *_CANDIDATES) if env_path else _CANDIDATES:
+        if isinstance(candidate, Path) and not candidate.exists():
+            continue
+        try:
+            return str(ImageFont.truetype(str(candidate), 12).path)
+        except OSError:
+            continue
+    return None
+
+
+def bucket_size(size: int) -> int:
+    """Кегль, округлённый вниз до ступени ``size // 24`` (не больше ~4%)."""
+    return size - size % max(1, size // 24)
+
+
+@lru_cache(maxsize=128)
+def _font(size: int) -> Font:
+    path = font_path()
+    if path is None:
+        return ImageFont.load_default()
+    return ImageFont.truetype(path, size)
+
+
+def get_font(size: int) -> Font:
+    """Шрифт кегля ``bucket_size(size)``; один объект на кегль в процессе."""
+    return _font(bucket_size(size))
+
+
+@lru_cache(maxsize=4096)
+def text_length(text: str, font: Font) -> float:
+    return _measure.textlength(text, font=font)
+
+
+@lru_cache(maxsize=1024)
+def text_bbox(text: str, font: Font, stroke_width: int = 0) -> tuple[int, int, int, int]:
+    """Рамка текста от точки (0, 0), как ``ImageDraw.textbbox``."""
+    return _measure.textbbox((0, 0), text, font=font, stroke_width=stroke_width)
+
+
+@lru_cache(maxsize=1024)
+def wrap_text(text: str, font: Font, max_width: int) -> tuple[str, ...]:
+    """Разбивает текст по словам на строки не шире ``max_width`` (слово длиннее —
+    отдельной строкой)."""
+    words = text.split()
+    if not words:
+        return ("",)
+
+    lines: list[str] = []
+    current_line = words[0]
+
+    for word in words[1:]:
+        trial = f"{current_line} {word}".strip()
+        if text_length(trial, font) <= max_width:
+            current_line = trial
+        else:
+            lines.append(current_line)
+            current_line = word
+
+    lines.append(current_line)
+    return tuple(lines)
@@ -0,0 +1,294 @@
+from __future__ import annotations
+
+import asyncio
+import marshal
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from copy import copy
+from pathlib import Path
+from typing import Any, Callable, Mapping, Optional, TypeVar
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from .config import Settings
+from .links import DATA_DIR
+
+T = TypeVar("T")
+
+FSM_DB_PATH = DATA_DIR / "fsm.db"
+
+
+class ExpiringMemoryStorage(MemoryStorage):
+    """MemoryStorage, который забывает брошенные диалоги.
+
+    Запись удаляется, если её не меняли дольше ``ttl`` секунд, а также сразу после
+    ``state.clear()``. Чтение не создаёт пустых записей (у MemoryStorage любое
+    сообщение от нового пользователя оставляет запись в словаре навсегда).
+    """
+
+    def __init__(self, ttl: float, sweep_interval: float = 60.0) -> None:
+        super().__init__()
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self._touched: dict[StorageKey, float] = {}
+        self._sweeper: Optional[asyncio.Task[None]] = None
+
+    def _touch(self, key: StorageKey) -> None:
+        record = self.storage.get(key)
+        if record is not None and record.state is None and not record.data:
+            del self.storage[key]
+            self._touched.pop(key, None)
+            return
+        self._touched[key] = time.monotonic()
+        if self._sweeper is None and self.ttl > 0:
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    def sweep(self) -> int:
+        """Удаляет просроченные записи; возвращает их число."""
+        deadline = time.monotonic() - self.ttl
+        expired = [key for key, touched in self._touched.items() if touched < deadline]
+        for key in expired:
+            self.storage.pop(key, None)
+            del self._touched[key]
+        return len(expired)
+
+    async def _sweep_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            self.sweep()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await super().set_state(key, state)
+        self._touch(key)
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        await super().set_data(key, data)
+        self._touch(key)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = self.storage.get(key)
+        return record.state if record is not None else None
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        record = self.storage.get(key)
+        return record.data.copy() if record is not None else {}
+
+    async def get_value(
+        self,
+        storage_key: StorageKey,
+        dict_key: str,
+        default: Optional[Any] = None,
+    ) -> Optional[Any]:
+        record = self.storage.get(storage_key)
+        if record is None:
+            return default
+        return copy(record.data.get(dict_key, default))
+
+    def entries(self) -> int:
+        """Сколько диалогов сейчас хранится."""
+        return len(self.storage)
+
+    async def close(self) -> None:
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+
+
+_EMPTY_DATA = marshal.dumps({})
+
+_UPSERT_BOTH = (
+    "INSERT INTO fsm(key, state, data, expires_at) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data, "
+    "expires_at = excluded.expires_at"
+)
+# При частичном обновлении просроченной записи её старая половина не воскрешается
+_UPSERT_STATE = (
+    "INSERT INTO fsm(key, state, data, expires_at) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT(key) DO UPDATE SET state = excluded.state, "
+    "data = CASE WHEN fsm.expires_at > ? THEN fsm.data ELSE excluded.data END, "
+    "expires_at = excluded.expires_at"
+)
+_UPSERT_DATA = (
+    "INSERT INTO fsm(key, state, data, expires_at) VALUES (?, NULL, ?, ?) "
+    "ON CONFLICT(key) DO UPDATE SET data = excluded.data, "
+    "state = CASE WHEN fsm.expires_at > ? THEN fsm.state ELSE NULL END, "
+    "expires_at = excluded.expires_at"
+)
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище в локальном SQLite (WAL), общее для нескольких процессов.
+
+    Нужно, чтобы состояние диалогов переживало перезапуск и было видно всем
+    webhook-воркерам на одной машине — без Redis и других внешних сервисов.
+
+    - Записи, пришедшие почти одновременно, коммитятся одной транзакцией
+      (group commit); ``set_state``/``set_data`` возвращаются после коммита,
+      поэтому другой процесс сразу видит изменения.
+    - Данные хранятся в ``marshal``: компактно и быстро, но только для встроенных
+      типов (str, int, float, bytes, list, dict...). Обработчики кладут в state
+      только такие значения.
+    - У каждой записи есть срок жизни ``ttl``, продлеваемый при каждой записи;
+      просроченные записи не читаются и периодически удаляются.
+    """
+
+    def __init__(
+        self,
+        path: Path = FSM_DB_PATH,
+        ttl: float = 3600.0,
+        batch_delay: float = 0.002,
+        sweep_interval: float = 60.0,
+    ) -> None:
+        self.path = Path(path)
+        self.ttl = ttl
+        self.batch_delay = batch_delay
+        self.sweep_interval = sweep_interval
+        self.key_builder = DefaultKeyBuilder(
+            with_bot_id=True,
+            with_business_connection_id=True,
+            with_destiny=True,
+        )
+        # Одна нить на соединение: sqlite3 не любит делить соединение между потоками
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fsm-sqlite")
+        self._db: Optional[sqlite3.Connection] = None
+        self._pending: dict[str, dict[str, Any]] = {}
+        self._writing: dict[str, dict[str, Any]] = {}
+        self._batch: Optional[asyncio.Future[None]] = None
+        self._last_sweep = 0.0
+
+    # --- операции в потоке БД ---
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS fsm (
+                    key TEXT PRIMARY KEY,
+                    state TEXT,
+                    data BLOB NOT NULL,
+                    expires_at REAL NOT NULL
+                ) WITHOUT ROWID
+                """
+            )
+            self._db = db
+        return self._db
+
+    def _write_batch(self, batch: dict[str, dict[str, Any]]) -> None:
+        db = self._connect()
+        now = time.time()
+        expires_at = now + self.ttl if self.ttl > 0 else float("inf")
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            for key, fields in batch.items():
+                if "state" in fields and "data" in fields:
+                    db.execute(_UPSERT_BOTH, (key, fields["state"], fields["data"], expires_at))
+                elif "state" in fields:
+                    db.execute(
+                        _UPSERT_STATE,
+                        (key, fields["state"], _EMPTY_DATA, expires_at, now),
+                    )
+                else:
+                    db.execute(_UPSERT_DATA, (key, fields["data"], expires_at, now))
+                # Пустая запись (после state.clear()) не нужна
+                db.execute(
+                    "DELETE FROM fsm WHERE key = ? AND state IS NULL AND data = ?",
+                    (key, _EMPTY_DATA),
+                )
+            if now - self._last_sweep >= self.sweep_interval:
+                db.execute("DELETE FROM fsm WHERE expires_at <= ?", (now,))
+                self._last_sweep = now
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def _read(self, key: str) -> Optional[tuple[Optional[str], bytes]]:
+        return self._connect().execute(
+            "SELECT state, data FROM fsm WHERE key = ? AND expires_at > ?",
+            (key, time.time()),
+        ).fetchone()
+
+    def _close_db(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    # --- асинхронная часть ---
+
+    async def _run(self, fn: Callable[..., T], *args: Any) -> T:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def _flush(self, batch_future: asyncio.Future[None]) -> None:
+        # Даём соседним корутинам дописать свои изменения в ту же транзакцию
+        await asyncio.sleep(self.batch_delay)
+        batch, self._pending, self._batch = self._pending, {}, None
+        self._writing = batch
+        try:
+            await self._run(self._write_batch, batch)
+        except BaseException as e:
+            batch_future.set_exception(e)
+        else:
+            batch_future.set_result(None)
+        finally:
+            if self._writing is batch:
+                self._writing = {}
+
+    async def _write(self, key: StorageKey, field: str, value: Any) -> None:
+        self._pending.setdefault(self.key_builder.build(key), {})[field] = value
+        if self._batch is None:
+            self._batch = asyncio.get_running_loop().create_future()
+            asyncio.create_task(self._flush(self._batch))
+        await asyncio.shield(self._batch)
+
+    async def _get(self, key: StorageKey) -> tuple[Optional[str], dict[str, Any]]:
+        skey = self.key_builder.build(key)
+        row = await self._run(self._read, skey)
+        state, data = (row[0], marshal.loads(row[1])) if row else (None, {})
+        # Ещё не закоммиченные изменения этого процесса важнее прочитанного
+        for pending in (self._writing.get(skey), self._pending.get(skey)):
+            if pending:
+                state = pending.get("state", state)
+                if "data" in pending:
+                    data = marshal.loads(pending["data"])
+        return state, data
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self._write(key, "state", state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._get(key))[0]
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        await self._write(key, "data", marshal.dumps(dict(data)))
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        return (await self._get(key))[1]
+
+    def entries(self) -> int:
+        """Сколько живых записей в БД (отдельное соединение: вызывается не из потока БД)."""
+        if not self.path.exists():
+            return 0
+        with closing(sqlite3.connect(self.path, timeout=5)) as db:
+            return db.execute(
+                "SELECT COUNT(*) FROM fsm WHERE expires_at > ?", (time.time(),)
+            ).fetchone()[0]
+
+    async def close(self) -> None:
+        if self._batch is not None:
+            await asyncio.shield(self._batch)
+        await self._run(self._close_db)
+        self._executor.shutdown(wait=True)
+
+
+def create_storage(settings: Settings) -> BaseStorage:
+    if settings.fsm_storage == "sqlite":
+        return SQLiteStorage(ttl=settings.fsm_ttl)
+    return ExpiringMemoryStorage(ttl=settings.fsm_ttl)
@@ -1,80 +1,94 @@
 from __future__ import annotations
 
 import io
-from typing import List
-
-from PIL import Image, ImageDraw, ImageFont
-from pathlib import Path
 import os
+from typing import List, Sequence
+
+from PIL import Image, ImageDraw
+
+from .encoders import ProfileLike, encode
+from .fonts import Font, bucket_size, get_font, text_bbox, wrap_text
+from .lru import ByteLRU
+from .metrics import WATERMARK_CACHE, span
 
-def _load_font(image_width: int) -> ImageFont.ImageFont:
-    base_size = max(18, int(image_width * 0.06))
-    here = Path(__file__).resolve().parent.parent
-    candidates = []
+# Кэши плиточного водяного знака: повёрнутая плитка и собранный слой под размер кадра.
+# Бюджет слоёв задаётся в мегабайтах; плиткам хватает малой доли от него.
+_CACHE_MB = int(os.getenv("WATERMARK_CACHE_MB", "128") or 0)
+_tile_cache: ByteLRU[tuple, Image.Image] = ByteLRU(_CACHE_MB * 1024 * 1024 // 16)
+_layer_cache: ByteLRU[tuple, Image.Image] = ByteLRU(_CACHE_MB * 1024 * 1024)
 
-    env_path = os.getenv("WATERMARK_FONT_PATH")
-    if env_path:
-        candidates.append(Path(env_path))
+# Слои строятся с запасом до кратного шагу размера, чтобы кадры близких размеров
+# (например, 1280x960 и 1280x853) использовали один и тот же слой.
+_LAYER_BUCKET = 256
 
-    candidates += [
-        here / "fonts" / "NotoSans-Regular.ttf",
-        here / "fonts" / "DejaVuSans.ttf",
-        Path("/usr/share/fonts/truetype/noto/NotoSans-Regular.ttf"),
-        Path("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"),
-        Path("/usr/share/fonts/truetype/freefont/FreeSans.ttf"),
-    ]
+# Максимальная длинная сторона результата (0 — без ограничения). Крупнее для
+# просмотра в Telegram и по ссылке не нужно, а память на рендер растёт с площадью.
+MAX_OUTPUT_EDGE = int(os.getenv("WATERMARK_MAX_EDGE", "2560") or 0)
 
-    for p in candidates:
-        try:
-            if p and p.exists():
-                return ImageFont.truetype(str(p), base_size)
-        except Exception:
-            continue
 
-    return ImageFont.load_default()
+def cache_stats() -> dict[str, dict[str, int]]:
+    """Счётчики кэшей водяного знака в текущем процессе.
+
+    Рендер идёт в процессах пула, поэтому в процессе бота здесь нули; попадания
+    и промахи всех воркеров — в ``photobot_watermark_cache_total`` на ``/metrics``.
+    """
+    return {"tile": _tile_cache.stats(), "layer": _layer_cache.stats()}
 
 
-def _wrap_text_by_width(
+def _image_nbytes(image: Image.Image) -> int:
+    return image.width * image.height * len(image.getbands())
+
+
+def _open_rgb(image_bytes: bytes, max_edge: int | None = None) -> Image.Image:
+    """Декодирует изображение сразу в RGB, уменьшая его до ``max_edge`` по длинной стороне.
+
+    Для JPEG уменьшение происходит ещё при декодировании (``draft``: масштаб 1/2, 1/4,
+    1/8), так что полноразмерный кадр в память не попадает. Альфа-канал исходника
+    отбрасывается, как и раньше при сохранении в JPEG.
+    """
+    if max_edge is None:
+        max_edge = MAX_OUTPUT_EDGE
+
+    with span("decode"), Image.open(io.BytesIO(image_bytes)) as im:
+        width, height = im.size
+        longest = max(width, height)
+        if max_edge and longest > max_edge:
+            im.draft(
+                "RGB",
+                (-(-width * max_edge // longest), -(-height * max_edge // longest)),
+            )
+            image = im.convert("RGB")
+            image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+            return image
+        return im.convert("RGB")
+
+
+def _load_font(image_width: int) -> Font:
+    return get_font(max(18, int(image_width * 0.06)))
+
+
+def render_text_on_image_bottom(
+    image_bytes: bytes,
     text: str,
-    draw: ImageDraw.ImageDraw,
-    font: ImageFont.ImageFont,
-    max_width: int,
-) -> List[str]:
-    words = text.split()
-    if not words:
-        return [""]
-
-    lines: List[str] = []
-    current_line = words[0]
-
-    for word in words[1:]:
-        trial = f"{current_line} {word}".strip()
-        if draw.textlength(trial, font=font) <= max_width:
-            current_line = trial
-        else:
-            lines.append(current_line)
-            current_line = word
-
-    lines.append(current_line)
-    return lines
-
-
-def render_text_on_image_bottom(image_bytes: bytes, text: str) -> bytes:
+    max_edge: int | None = None,
+    profile: ProfileLike = None,
+) -> bytes:
     """Оставлено для совместимости: подпись снизу с плашкой."""
     if not text:
         return image_bytes
 
-    with Image.open(io.BytesIO(image_bytes)) as im:
-        image = im.convert("RGBA")
+    image = _open_rgb(image_bytes, max_edge)
 
-    draw = ImageDraw.Draw(image, "RGBA")
+    # Рисуем прямо в RGB. Раньше рисование шло в RGBA без смешивания, а альфа
+    # отбрасывалась при сохранении, поэтому цвета ниже дают тот же результат.
+    draw = ImageDraw.Draw(image)
     font = _load_font(image.width)
 
     padding = max(10, int(image.width * 0.03))
     spacing = max(4, int(font.size * 0.3))
     max_text_width = image.width - 2 * padding
 
-    lines = _wrap_text_by_width(text, draw, font, max_text_width)
+    lines = wrap_text(text, font, max_text_width)
     block = "\n".join(lines)
 
     bbox = draw.multiline_textbbox(
@@ -90,7 +104,7 @@ def render_text_on_image_bottom(image_bytes: bytes, text: str) -> bytes:
 
     y0 = max(0, image.height - bar_h)
 
-    draw.rectangle([(0, y0), (image.width, image.height)], fill=(0, 0, 0, 160))
+    draw.rectangle([(0, y0), (image.width, image.height)], fill=(0, 0, 0))
 
     x = int((image.width - text_w) / 2)
     y = int(y0 + padding)
@@ -99,19 +113,22 @@ def render_text_on_image_bottom(image_bytes: bytes, text: str) -> bytes:
         (x, y),
         block,
         font=font,
-        fill=(255, 255, 255, 255),
+        fill=(255, 255, 255),
         spacing=spacing,
         stroke_width=2,
-        stroke_fill=(0, 0, 0, 200),
+        stroke_fill=(0, 0, 0),
         align="center",
     )
 
-    out = io.BytesIO()
-    image.convert("RGB").save(out, format="JPEG", quality=95, optimize=True)
-    return out.getvalue()
+    return encode(image, profile)
 
 
-def render_watermark_center(image_bytes: bytes, text: str) -> bytes:
+def render_watermark_center(
+    image_bytes: bytes,
+    text: str,
+    max_edge: int | None = None,
+    profile: ProfileLike = None,
+) -> bytes:
     """Накладывает полупрозрачный водяной знак (текст) по центру, под углом.
 
     Параметры подобраны по умолчанию: угол ~30°, белый текст с чёрной обводкой,
@@ -120,27 +137,16 @@ def render_watermark_center(image_bytes: bytes, text: str) -> bytes:
     if not text:
         return image_bytes
 
-    with Image.open(io.BytesIO(image_bytes)) as im:
-        base = im.convert("RGBA")
+    base = _open_rgb(image_bytes, max_edge)
 
     width, height = base.size
 
     # Размер шрифта от меньшей стороны изображения
     font_size = max(16, int(min(width, height) * 0.12))
-    try:
-        font = ImageFont.truetype("DejaVuSans.ttf", font_size)
-    except OSError:
-        try:
-            font = ImageFont.truetype("arial.ttf", font_size)
-        except OSError:
-            font = ImageFont.load_default()
-
-    # Отрисуем текст на отдельном слое и повернём
-    txt_layer = Image.new("RGBA", base.size, (0, 0, 0, 0))
-    draw = ImageDraw.Draw(txt_layer)
+    font = get_font(font_size)
 
     # Предварительно посчитаем размер текста
-    bbox = draw.textbbox((0, 0), text, font=font, stroke_width=2)
+    bbox = text_bbox(text, font, 2)
     text_w = bbox[2] - bbox[0]
     text_h = bbox[3] - bbox[1]
 
@@ -167,45 +173,55 @@ def render_watermark_center(image_bytes: bytes, text: str) -> bytes:
     x = (width - rx) // 2
     y = (height - ry) // 2
 
-    txt_layer.alpha_composite(rotated, (x, y))
+    # Накладываем только область плитки: альфа плитки служит маской
+    base.paste(rotated, (x, y), rotated)
 
-    # Комбинируем
-    watermarked = Image.alpha_composite(base, txt_layer)
+    return encode(base, profile)
 
-    out = io.BytesIO()
-    watermarked.convert("RGB").save(out, format="JPEG", quality=95, optimize=True)
-    return out.getvalue()
 
+def _output_size(image_bytes: bytes, max_edge: int | None = None) -> tuple[int, int]:
+    """Размер кадра после :func:`_open_rgb` — по заголовку, без декодирования.
 
-def render_watermark_tiled(image_bytes: bytes, text: str) -> bytes:
-    """Плиточный водяной знак по всей площади (диагонально).
-
-    - Повторяющиеся полупрозрачные надписи по диагонали.
-    - Умеренная плотность за счёт небольшого шага и смещения строк.
+    Округление может разойтись с ``thumbnail`` на пиксель; годится для планирования.
     """
-    if not text:
-        return image_bytes
-
+    if max_edge is None:
+        max_edge = MAX_OUTPUT_EDGE
     with Image.open(io.BytesIO(image_bytes)) as im:
-        base = im.convert("RGBA")
+        width, height = im.size
+    longest = max(width, height)
+    if max_edge and longest > max_edge:
+        return (
+            max(1, round(width * max_edge / longest)),
+            max(1, round(height * max_edge / longest)),
+        )
+    return width, height
 
-    width, height = base.size
 
+def _tiled_font_size(width: int, height: int) -> int:
     # Делаем шрифт компактнее, чтобы паттерн был частым
-    font_size = max(12, int(min(width, height) * 0.05))
-    try:
-        font = ImageFont.truetype("DejaVuSans.ttf", font_size)
-    except OSError:
-        try:
-            font = ImageFont.truetype("arial.ttf", font_size)
-        except OSError:
-            font = ImageFont.load_default()
+    # Кегль по ступеням: кадры близкого размера делят шрифт, плитку и слой
+    return bucket_size(max(12, int(min(width, height) * 0.05)))
+
+
+def _tiled_font(font_size: int) -> Font:
+    return get_font(font_size)
+
+
+def _font_key(font: Font) -> str:
+    return str(getattr(font, "path", "") or "default")
+
+
+def _tiled_tile(text: str, font: Font, font_size: int) -> Image.Image:
+    """Повёрнутая плитка с текстом (из кэша, если уже строилась)."""
+    key = (text, _font_key(font), font_size)
+    rotated = _tile_cache.get(key)
+    WATERMARK_CACHE.inc(cache="tile", result="miss" if rotated is None else "hit")
+    if rotated is not None:
+        return rotated
 
     # Плитка с текстом
     pad = max(4, font_size // 8)
-    tmp = Image.new("RGBA", (1, 1), (0, 0, 0, 0))
-    dtmp = ImageDraw.Draw(tmp)
-    bbox = dtmp.textbbox((0, 0), text, font=font, stroke_width=2)
+    bbox = text_bbox(text, font, 2)
     text_w = bbox[2] - bbox[0]
     text_h = bbox[3] - bbox[1]
 
@@ -223,34 +239,138 @@ def render_watermark_tiled(image_bytes: bytes, text: str) -> bytes:
     # Поворачиваем плитку
     angle = 30
     rotated = tile.rotate(angle, expand=True, resample=Image.BICUBIC)
+    _tile_cache.put(key, rotated, _image_nbytes(rotated))
+    return rotated
+
+
+def _tiled_cell(rotated: Image.Image, step_x: int, step_y: int) -> Image.Image:
+    """Одна ячейка периодического узора размером ``step_x x 2*step_y``.
+
+    Ряды узора начинаются с ``y = -rh``, поэтому у верхнего края кадра лежит
+    нечётный ряд со сдвигом на полшага; его правая часть переносится в начало ячейки.
+    """
+    cell = Image.new("RGBA", (step_x, 2 * step_y), (0, 0, 0, 0))
+    half = step_x // 2
+    cell.paste(rotated, (half, 0))
+    cell.paste(rotated, (half - step_x, 0))
+    cell.paste(rotated, (0, step_y))
+    return cell
+
+
+def _fill_periodic(cell: Image.Image, width: int, height: int) -> Image.Image:
+    """Замощает кадр ячейкой без попиксельного наложения.
+
+    Сначала удвоением собирается полоса на всю ширину (O(log n) вызовов ``paste``),
+    затем она копируется вниз — по одному ``paste`` на период по вертикали.
+    """
+    cw, ch = cell.size
+    strip = Image.new("RGBA", (width, ch), (0, 0, 0, 0))
+    strip.paste(cell, (0, 0))
+    filled = cw
+    while filled < width:
+        strip.paste(strip.crop((0, 0, filled, ch)), (filled, 0))
+        filled *= 2
+
+    layer = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+    for y in range(0, height, ch):
+        layer.paste(strip, (0, y))
+    return layer
+
+
+def _tiled_layer(text: str, font_size: int, width: int, height: int) -> Image.Image:
+    """Слой водяного знака не меньше ``width x height``.
+
+    Узор привязан к левому верхнему углу, поэтому слой, построенный для
+    округлённого вверх размера, годится для любого кадра не больше его.
+    """
+    font = _tiled_font(font_size)
+    bw = -(-width // _LAYER_BUCKET) * _LAYER_BUCKET
+    bh = -(-height // _LAYER_BUCKET) * _LAYER_BUCKET
+    key = (text, _font_key(font), font_size, bw, bh)
+    layer = _layer_cache.get(key)
+    WATERMARK_CACHE.inc(cache="layer", result="miss" if layer is None else "hit")
+    if layer is not None:
+        return layer
+
+    rotated = _tiled_tile(text, font, font_size)
     rw, rh = rotated.size
 
-    # Создаём слой и заполняем; шаг делаем меньше ширины/высоты плитки,
-    # чтобы паттерн точно повторялся заметно.
-    layer = Image.new("RGBA", base.size, (0, 0, 0, 0))
-    # Увеличиваем шаг до 1.0 * размер плитки (было 0.7),
-    # это даёт примерно вдвое меньше повторов по площади
+    # Шаг равен размеру плитки, поэтому плитки не перекрываются, и узор
+    # периодичен с периодом (step_x, 2 * step_y): ряды чередуют смещение на полшага.
     step_x = max(1, int(rw * 1.0))
     step_y = max(1, int(rh * 1.0))
+    layer = _fill_periodic(_tiled_cell(rotated, step_x, step_y), bw, bh)
 
-    # Шахматное смещение: каждый чётный ряд начинаем с полшага вправо
-    start_y = -rh
-    y = start_y
-    row = 0
-    while y < height + rh:
-        offset_x = -rw + (step_x // 2 if row % 2 else 0)
-        x = offset_x
-        while x < width + rw:
-            layer.alpha_composite(rotated, (x, y))
-            x += step_x
-        y += step_y
-        row += 1
-
-    out = io.BytesIO()
-    Image.alpha_composite(base, layer).convert("RGB").save(
-        out,
-        format="JPEG",
-        quality=95,
-        optimize=True,
-    )
-    return out.getvalue()
+    _layer_cache.put(key, layer, _image_nbytes(layer))
+    return layer
+
+
+def render_watermark_tiled(
+    image_bytes: bytes,
+    text: str,
+    max_edge: int | None = None,
+    profile: ProfileLike = None,
+) -> bytes:
+    """Плиточный водяной знак по всей площади (диагонально).
+
+    - Повторяющиеся полупрозрачные надписи по диагонали.
+    - Умеренная плотность за счёт небольшого шага и смещения строк.
+    - Плитка и собранный слой кэшируются: одинаковая подпись на кадрах
+      близкого размера стоит одного наложения.
+    """
+    if not text:
+        return image_bytes
+
+    base = _open_rgb(image_bytes, max_edge)
+
+    width, height = base.size
+
+    with span("composite"):
+        font_size = _tiled_font_size(width, height)
+        layer = _tiled_layer(text, font_size, width, height)
+        # Кадр остаётся RGB: слой накладывается с собственной альфой как маской,
+        # без полноразмерной RGBA-копии. Отличие от alpha_composite — не больше 1 в канале.
+        base.paste(layer, (0, 0), layer)
+
+    return encode(base, profile)
+
+
+def render_watermark_tiled_batch(
+    images: Sequence[bytes],
+    text: str,
+    max_edge: int | None = None,
+    profile: ProfileLike = None,
+) -> List[bytes]:
+    """Плиточный водяной знак на несколько кадров (альбом) одним заданием.
+
+    Размеры кадров известны заранее по заголовкам, поэтому слой для каждого
+    размера шрифта собирается один раз — под наибольший кадр с этим шрифтом —
+    и накладывается на все. Кадры декодируются по одному, в памяти одновременно
+    лежит только текущий. Результат каждого кадра совпадает с
+    :func:`render_watermark_tiled`.
+    """
+    if not text:
+        return [bytes(image) for image in images]
+
+    planned: dict[int, tuple[int, int]] = {}
+    for image_bytes in images:
+        width, height = _output_size(image_bytes, max_edge)
+        font_size = _tiled_font_size(width, height)
+        pw, ph = planned.get(font_size, (0, 0))
+        planned[font_size] = (max(pw, width), max(ph, height))
+    with span("composite"):
+        layers = {fs: _tiled_layer(text, fs, w, h) for fs, (w, h) in planned.items()}
+
+    results: List[bytes] = []
+    for image_bytes in images:
+        base = _open_rgb(image_bytes, max_edge)
+        width, height = base.size
+        with span("composite"):
+            font_size = _tiled_font_size(width, height)
+            layer = layers.get(font_size)
+            if layer is None or layer.width < width or layer.height < height:
+                # Оценка размера промахнулась на пиксель — строим слой как обычно
+                layer = _tiled_layer(text, font_size, width, height)
+            base.paste(layer, (0, 0), layer)
+        results.append(encode(base, profile))
+    return results
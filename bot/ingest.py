@@ -0,0 +1,194 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+from aiogram.types import Update
+from aiogram.types.update import UpdateTypeLookupError
+
+logger = logging.getLogger(__name__)
+
+
+class _Timing:
+    """Счётчик длительностей: количество, сумма, максимум и перцентили по
+    последним ``window`` замерам."""
+
+    def __init__(self, window: int = 1024) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._recent: deque[float] = deque(maxlen=window)
+
+    def add(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self._recent.append(seconds)
+
+    def stats(self) -> dict[str, float]:
+        recent = sorted(self._recent.copy())  # copy атомарна, итерация — нет
+        n = len(recent)
+        return {
+            "count": self.count,
+            "avg_ms": self.total / self.count * 1000 if self.count else 0.0,
+            "p50_ms": recent[n // 2] * 1000 if n else 0.0,
+            "p99_ms": recent[min(n - 1, int(n * 0.99))] * 1000 if n else 0.0,
+            "max_ms": self.max * 1000,
+        }
+
+
+def chat_key(update: Update) -> Hashable:
+    """Ключ упорядочивания: апдейты одного чата обрабатываются строго по очереди."""
+    try:
+        event = update.event
+    except UpdateTypeLookupError:
+        # Тип апдейта, которого эта версия aiogram не знает: чата не определить
+        return ("update", update.update_id)
+    chat = getattr(event, "chat", None) or getattr(getattr(event, "message", None), "chat", None)
+    if chat is not None:
+        return ("chat", chat.id)
+    user = getattr(event, "from_user", None)
+    if user is not None:
+        return ("user", user.id)
+    return ("update", update.update_id)
+
+
+class UpdateQueue:
+    """Ограниченная очередь апдейтов между webhook-потоками и event loop.
+
+    :meth:`offer` вызывается из любого потока и сразу решает, принят ли апдейт:
+    в очереди ждут не больше ``max_size`` апдейтов. Их разбирают ``workers``
+    корутин в ``loop``; апдейты одного чата идут по порядку и никогда не
+    обрабатываются параллельно, разные чаты — параллельно.
+
+    Когда очередь полна, политика ``"defer"`` отвечает отказом (webhook вернёт
+    Telegram ошибку, и тот повторит доставку позже), а ``"drop"`` выбрасывает
+    апдейт.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[Update], Awaitable[Any]],
+        loop: asyncio.AbstractEventLoop,
+        workers: int,
+        max_size: int,
+        policy: str = "defer",
+    ) -> None:
+        if policy not in ("defer", "drop"):
+            raise ValueError(f"unknown ingest policy: {policy!r}")
+        self.handler = handler
+        self.loop = loop
+        self.workers = max(1, workers)
+        self.max_size = max(1, max_size)
+        self.policy = policy
+        self._lock = threading.Lock()
+        self._depth = 0
+        self._busy = 0
+        self._accepted = 0
+        self._rejected = 0
+        self._failed = 0
+        self.wait_time = _Timing()
+        self.process_time = _Timing()
+        # Состояние ниже трогается только из потока loop
+        self._chats: dict[Hashable, deque[tuple[Update, float]]] = {}
+        self._ready: Optional[asyncio.Queue[Hashable]] = None
+        self._tasks: list[asyncio.Task[None]] = []
+
+    @property
+    def depth(self) -> int:
+        return self._depth
+
+    def offer(self, update: Update) -> bool:
+        """Ставит апдейт в очередь; ``False`` — очередь полна, апдейт не принят."""
+        # Ключ — до учёта в глубине: ошибка здесь не должна оставить занятое место
+        key = chat_key(update)
+        with self._lock:
+            if self._depth >= self.max_size:
+                self._rejected += 1
+                return False
+            self._depth += 1
+            self._accepted += 1
+        try:
+            self.loop.call_soon_threadsafe(self._enqueue, key, update, time.perf_counter())
+        except BaseException:
+            self._release_slot()
+            raise
+        return True
+
+    def _release_slot(self) -> None:
+        with self._lock:
+            self._depth -= 1
+            self._failed += 1
+
+    def _enqueue(self, key: Hashable, update: Update, enqueued_at: float) -> None:
+        try:
+            self._put(key, update, enqueued_at)
+        except Exception:
+            # Апдейт не попал в очередь: освобождаем место, иначе очередь «зарастёт»
+            self._release_slot()
+            logger.exception("Не удалось поставить в очередь апдейт %s", update.update_id)
+
+    def _put(self, key: Hashable, update: Update, enqueued_at: float) -> None:
+        if self._ready is None:
+            self._ready = asyncio.Queue()
+            self._tasks = [
+                self.loop.create_task(self._worker(), name=f"ingest-{i}")
+                for i in range(self.workers)
+            ]
+        pending = self._chats.get(key)
+        if pending is None:
+            self._chats[key] = deque([(update, enqueued_at)])
+            self._ready.put_nowait(key)
+        else:
+            # Чат уже в очереди или обрабатывается — встанет после предыдущих
+            pending.append((update, enqueued_at))
+
+    async def _worker(self) -> None:
+        assert self._ready is not None
+        while True:
+            key = await self._ready.get()
+            pending = self._chats[key]
+            update, enqueued_at = pending.popleft()
+            started = time.perf_counter()
+            with self._lock:
+                self._depth -= 1
+                self._busy += 1
+            self.wait_time.add(started - enqueued_at)
+            try:
+                await self.handler(update)
+            except Exception:
+                self._failed += 1
+                logger.exception("Ошибка обработки апдейта %s", update.update_id)
+            finally:
+                self.process_time.add(time.perf_counter() - started)
+                with self._lock:
+                    self._busy -= 1
+            if pending:
+                # Следующий апдейт чата — в конец общей очереди, чтобы не занимать воркер
+                self._ready.put_nowait(key)
+            else:
+                del self._chats[key]
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "depth": self._depth,
+            "max_size": self.max_size,
+            "busy": self._busy,
+            "workers": self.workers,
+            "policy": self.policy,
+            "accepted": self._accepted,
+            "rejected": self._rejected,
+            "failed": self._failed,
+            "wait": self.wait_time.stats(),
+            "processing": self.process_time.stats(),
+        }
+
+    def close(self) -> None:
+        """Останавливает воркеры (вызывать из потока loop)."""
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
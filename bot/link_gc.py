@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import logging
+import threading
+from typing import Any, Optional
+
+from .links import ReapHook, Reclaimed, reap_exhausted, reap_expired, reap_orphan_files
+
+logger = logging.getLogger(__name__)
+
+
+class LinkSweeper:
+    """Фоновая уборка хранилища ссылок в отдельном потоке.
+
+    Раз в ``interval`` секунд удаляет просроченные и исчерпанные записи вместе с
+    файлами, на которые больше никто не ссылается; раз в ``orphan_interval``
+    секунд проходит по каталогу файлов и удаляет файлы без записей. Работа идёт
+    пачками по ``batch`` записей в отдельных коротких транзакциях, так что
+    ``consume_view`` ждёт блокировку записи не дольше одной пачки.
+
+    ``on_reap`` получает удалённые записи после каждой пачки: процесс сервера
+    ссылок убирает их из своих кэшей.
+    """
+
+    def __init__(
+        self,
+        interval: float = 60.0,
+        batch: int = 500,
+        orphan_interval: float = 3600.0,
+        on_reap: Optional[ReapHook] = None,
+    ) -> None:
+        self.interval = interval
+        self.batch = batch
+        self.orphan_interval = orphan_interval
+        self.on_reap = on_reap
+        self.total = Reclaimed()
+        self.runs = 0
+        self._since_orphans = orphan_interval  # первый проход проверяет и файлы
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="link-sweeper", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception("Не удалось убрать просроченные ссылки")
+            if self._stop.wait(self.interval):
+                return
+
+    def _drain(self, reap: Any) -> Reclaimed:
+        result = Reclaimed()
+        while not self._stop.is_set():
+            step = reap(self.batch, on_removed=self.on_reap)
+            result += step
+            if step.rows < self.batch:
+                break
+        return result
+
+    def sweep(self) -> Reclaimed:
+        """Один проход уборки; возвращает освобождённое за него."""
+        result = self._drain(reap_expired)
+        result += self._drain(reap_exhausted)
+        self._since_orphans += self.interval
+        if self._since_orphans >= self.orphan_interval and not self._stop.is_set():
+            self._since_orphans = 0.0
+            result += reap_orphan_files(self.batch)
+        self.total += result
+        self.runs += 1
+        if result.rows or result.files:
+            logger.info(
+                "Уборка ссылок: удалено записей %d, файлов %d, освобождено %.1f МБ",
+                result.rows,
+                result.files,
+                result.bytes / (1024 * 1024),
+            )
+        return result
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "runs": self.runs,
+            "rows": self.total.rows,
+            "files": self.total.files,
+            "bytes": self.total.bytes,
+        }
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
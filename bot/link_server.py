@@ -1,13 +1,18 @@
 from __future__ import annotations
 
-import mimetypes
-from pathlib import Path
+import os
+import signal
+import sys
+from typing import Any
 
-from flask import Flask, abort, send_file
+from flask import Flask, Response, abort, request, send_file
 
-from .links import DATA_DIR, consume_view
+from .link_service import VARIANTS, cache_stats, gc_stats, open_view
+from .links import DATA_DIR
+from .metrics import add_flask_routes
 
 app = Flask(__name__)
+add_flask_routes(app)
 
 
 @app.get("/")
@@ -15,29 +20,45 @@ def root() -> dict[str, str]:
     return {"status": "ok"}
 
 
+@app.get("/stats")
+def stats() -> dict[str, Any]:
+    return {"file_cache": cache_stats(), "gc": gc_stats()}
+
+
 @app.get("/v/<token>")
 def view(token: str):
-    link = consume_view(token)
-    if not link:
-        abort(410)  # Gone (нет больше просмотров или не найдено)
-
-    path: Path = link.path
-    if not path.exists():
-        abort(404)
-
-    mime, _ = mimetypes.guess_type(path.name)
-    return send_file(
-        path,
-        as_attachment=False,
-        mimetype=mime or "image/jpeg",
-        download_name=path.name,
-        max_age=0,
-        conditional=True,
-        etag=True,
-        last_modified=path.stat().st_mtime,
-    )
+    status, found = open_view(token, request.headers.get("Accept", ""))
+    if found is None:
+        abort(status)  # 410 Gone (нет больше просмотров или не найдено), 404 — нет файла
+
+    if found.body is not None:
+        # Тело уже в памяти: отвечаем без обращения к диску
+        response = Response(found.body, mimetype=found.mimetype)
+        response.set_etag(found.etag)
+        response.last_modified = found.last_modified
+        response.cache_control.max_age = 0
+        response.make_conditional(request, accept_ranges=True, complete_length=len(found.body))
+    else:
+        try:
+            response = send_file(
+                found.path,
+                as_attachment=False,
+                mimetype=found.mimetype,
+                download_name=found.path.name,
+                max_age=0,
+                conditional=True,
+                etag=True,
+                last_modified=found.path.stat().st_mtime,
+            )
+        except FileNotFoundError:
+            abort(404)  # сборщик удалил файл после open_view
+    if VARIANTS:
+        response.vary.add("Accept")
+    return response
 
 
 if __name__ == "__main__":
+    # SIGTERM (docker stop) → обычный выход, чтобы atexit успел записать счётчики
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
     DATA_DIR.mkdir(parents=True, exist_ok=True)
-    app.run(host="0.0.0.0", port=8080)
+    app.run(host="0.0.0.0", port=int(os.getenv("LINK_SERVER_PORT", "8080")))
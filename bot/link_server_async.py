@@ -0,0 +1,93 @@
+"""asyncio-версия link_server на aiohttp (он уже есть в зависимостях aiogram).
+
+Один процесс с event loop держит тысячи медленных соединений: файл отдаётся через
+``loop.sendfile`` (``os.sendfile`` без копирования в user space) с поддержкой Range
+и условных запросов, а обращения к SQLite и к диску при выборе файла идут в
+небольшом пуле потоков и не блокируют loop.
+
+Запуск: ``python -m bot.link_server_async`` (порт — ``LINK_SERVER_PORT``, по умолчанию 8080).
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator
+
+from aiohttp import web
+from aiohttp.helpers import ETAG_ANY
+
+from .link_service import VARIANTS, cache_stats, gc_stats, open_view
+from .links import DATA_DIR
+from .metrics import add_aiohttp_routes, monitor_loop_lag
+
+# SQLite-операции короткие; нескольких потоков достаточно, чтобы loop не ждал диск
+_db_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("LINK_DB_THREADS", "4")),
+    thread_name_prefix="link-db",
+)
+
+
+async def root(request: web.Request) -> web.Response:
+    return web.json_response({"status": "ok"})
+
+
+async def stats(request: web.Request) -> web.Response:
+    return web.json_response({"file_cache": cache_stats(), "gc": gc_stats()})
+
+
+async def view(request: web.Request) -> web.StreamResponse:
+    token = request.match_info["token"]
+    accept = request.headers.get("Accept", "")
+    status, found = await asyncio.get_running_loop().run_in_executor(
+        _db_executor, open_view, token, accept
+    )
+    if found is None:
+        raise web.HTTPGone() if status == 410 else web.HTTPNotFound()
+
+    headers = {"Content-Type": found.mimetype, "Cache-Control": "no-cache"}
+    if VARIANTS:
+        headers["Vary"] = "Accept"
+    if found.body is None or "Range" in request.headers:
+        return web.FileResponse(found.path, headers=headers)
+
+    # Тело уже в памяти: отвечаем без обращения к диску
+    if any(tag.value in (found.etag, ETAG_ANY) for tag in request.if_none_match or ()):
+        response = web.Response(status=304, headers=headers)
+    else:
+        response = web.Response(body=found.body, headers=headers)
+    response.etag = found.etag
+    response.last_modified = found.last_modified
+    return response
+
+
+async def _loop_lag(app: web.Application) -> AsyncIterator[None]:
+    task = asyncio.create_task(monitor_loop_lag())
+    yield
+    task.cancel()
+
+
+def create_app() -> web.Application:
+    app = web.Application()
+    app.router.add_get("/", root)
+    app.router.add_get("/stats", stats)
+    app.router.add_get("/v/{token}", view)
+    add_aiohttp_routes(app)
+    app.cleanup_ctx.append(_loop_lag)
+    return app
+
+
+def main() -> None:
+    DATA_DIR.mkdir(parents=True, exist_ok=True)
+    # aiohttp сам обрабатывает SIGTERM/SIGINT, после чего срабатывает atexit
+    web.run_app(
+        create_app(),
+        host="0.0.0.0",
+        port=int(os.getenv("LINK_SERVER_PORT", "8080")),
+        access_log=None,
+    )
+
+
+if __name__ == "__main__":
+    main()
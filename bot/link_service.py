@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+import atexit
+import hashlib
+import mimetypes
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Optional
+
+from .encoders import LINK_VARIANTS, negotiate, variant_path
+from .link_gc import LinkSweeper
+from .links import consume_view
+from .lru import ByteLRU
+from .metrics import VIEWS, span
+from .view_counter import WriteBehindCounter
+
+# Форматы для браузера (LINK_VARIANTS). Варианты кодирует бот в пуле рендера после
+# ответа; сервер ссылок отдаёт только готовые и сам не кодирует: кодирование в
+# запросе заняло бы поток обработки на сотни миллисекунд.
+VARIANTS = LINK_VARIANTS
+
+# LINK_WRITE_BEHIND=1: счётчики популярных ссылок уменьшаются в памяти и пишутся
+# в БД пачками раз в LINK_FLUSH_INTERVAL секунд. Точно только для одного процесса,
+# подробности — в WriteBehindCounter.
+counter: Optional[WriteBehindCounter] = None
+consume = consume_view
+if os.getenv("LINK_WRITE_BEHIND", "").strip() in ("1", "true", "yes"):
+    counter = WriteBehindCounter(flush_interval=float(os.getenv("LINK_FLUSH_INTERVAL", "0.5")))
+    counter.start()
+    atexit.register(counter.close)
+    consume = counter.consume
+
+# Кэш тел популярных файлов в памяти процесса. Файлы крупнее LINK_CACHE_MAX_FILE_MB
+# всегда читаются с диска.
+_MB = 1024 * 1024
+file_cache: ByteLRU[tuple[str, str], "View"] = ByteLRU(
+    int(float(os.getenv("LINK_CACHE_MB", "64")) * _MB)
+)
+MAX_CACHED_FILE = int(float(os.getenv("LINK_CACHE_MAX_FILE_MB", "8")) * _MB)
+
+
+@dataclass(frozen=True)
+class View:
+    """Что отдать клиенту. Если ``body`` задано — тело уже в памяти вместе с
+    готовыми ``etag`` и ``last_modified``, и к диску обращаться не нужно."""
+
+    path: Path
+    mimetype: str
+    body: Optional[bytes] = None
+    etag: str = ""
+    last_modified: float = 0.0
+
+
+def _load_view(path: Path, mime: str) -> View:
+    stat = path.stat()
+    if stat.st_size > MAX_CACHED_FILE:
+        return View(path=path, mimetype=mime)
+    body = path.read_bytes()
+    return View(
+        path=path,
+        mimetype=mime,
+        body=body,
+        etag=hashlib.blake2b(body, digest_size=12).hexdigest(),
+        last_modified=stat.st_mtime,
+    )
+
+
+def invalidate_path(path: Path) -> None:
+    """Убирает из кэша файл и все его варианты (например, после удаления с диска)."""
+    for variant in ("", *(p.name for p in VARIANTS)):
+        file_cache.pop((str(path), variant))
+
+
+def _forget_reaped(removed: list[tuple[str, Path]]) -> None:
+    """Удалённые сборщиком ссылки не должны открываться из кэшей процесса."""
+    if counter is not None:
+        counter.forget(token for token, _ in removed)
+    for path in {path for _, path in removed}:
+        invalidate_path(path)
+
+
+# Фоновая уборка просроченных/исчерпанных ссылок и их файлов раз в
+# LINK_SWEEP_INTERVAL секунд (0 — выключена)
+sweeper: Optional[LinkSweeper] = None
+_sweep_interval = float(os.getenv("LINK_SWEEP_INTERVAL", "60") or 0)
+if _sweep_interval > 0:
+    sweeper = LinkSweeper(
+        interval=_sweep_interval,
+        batch=int(os.getenv("LINK_SWEEP_BATCH", "500")),
+        on_reap=_forget_reaped,
+    )
+    sweeper.start()
+    atexit.register(sweeper.close)
+
+
+def gc_stats() -> dict[str, Any]:
+    return sweeper.stats() if sweeper is not None else {}
+
+
+def cache_stats() -> dict[str, Any]:
+    stats: dict[str, Any] = file_cache.stats()
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+    return stats
+
+
+def open_view(token: str, accept: str = "") -> tuple[int, Optional[View]]:
+    """Списывает просмотр и выбирает файл для ответа.
+
+    Общая часть Flask- и asyncio-сервера. Возвращает HTTP-статус и файл:
+    410 — просмотров больше нет (или ссылки не было), 404 — файл пропал.
+    """
+    with span("link_open"):
+        status, found = _open_view(token, accept)
+    VIEWS.inc(status=str(status))
+    return status, found
+
+
+def _open_view(token: str, accept: str) -> tuple[int, Optional[View]]:
+    with span("link_consume"):
+        link = consume(token)
+    if not link:
+        return 410, None
+
+    variant = negotiate(accept, VARIANTS) if VARIANTS else None
+    if variant is not None and not variant_path(link.path, variant).exists():
+        variant = None  # ещё не готов — отдаём оригинал
+    key = (str(link.path), variant.name if variant else "")
+    found = file_cache.get(key)
+    if found is None:
+        path: Path = link.path
+        if not path.exists():
+            return 404, None
+
+        mime, _ = mimetypes.guess_type(path.name)
+        if variant is not None:
+            path, mime = variant_path(path, variant), variant.mimetype
+        try:
+            found = _load_view(path, mime or "image/jpeg")
+        except FileNotFoundError:
+            return 404, None
+        if found.body is not None:
+            file_cache.put(key, found, len(found.body))
+
+    if link.remaining <= 0:
+        # Последний просмотр: держать файл в памяти больше незачем
+        invalidate_path(link.path)
+    return 200, found
@@ -1,29 +1,80 @@
 from __future__ import annotations
 
+import hashlib
+import os
+import queue
 import secrets
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Iterable, Iterator, Optional
+
+from .encoders import PROFILES
+from .metrics import span
 
 BASE_DIR = Path(__file__).resolve().parent.parent
-DATA_DIR = BASE_DIR / "storage"
+DATA_DIR = Path(os.getenv("STORAGE_DIR", "").strip() or BASE_DIR / "storage")
 DB_PATH = DATA_DIR / "links.db"
 FILES_DIR = DATA_DIR / "files"
 
+# Сколько соединений с БД держит процесс (LINK_DB_POOL); потоки сверх этого ждут
+POOL_SIZE = max(1, int(os.getenv("LINK_DB_POOL", "8") or 8))
+
+# Срок жизни ссылки по умолчанию, секунд (LINK_TTL; 0 — бессрочно)
+DEFAULT_TTL = float(os.getenv("LINK_TTL", "0") or 0)
+
+# Сколько секунд исчерпанная запись живёт после последнего просмотра: сервер ссылок
+# читает файл уже после consume_view, и сборщик не должен удалить его в этот момент
+EXHAUSTED_GRACE = 60.0
+
 
 @dataclass
 class Link:
     token: str
     path: Path
     remaining: int
+    expires_at: Optional[float] = None
+
+
+# Получает удалённые сборщиком записи ``(token, путь)`` — например, чтобы убрать их
+# из кэшей процесса
+ReapHook = Callable[[list[tuple[str, Path]]], None]
+
+
+@dataclass
+class Reclaimed:
+    """Сколько освобождено за проход сборщика."""
+
+    rows: int = 0
+    files: int = 0
+    bytes: int = 0
+
+    def __iadd__(self, other: Reclaimed) -> Reclaimed:
+        self.rows += other.rows
+        self.files += other.files
+        self.bytes += other.bytes
+        return self
+
+
+_init_lock = threading.Lock()
+_initialized: set[tuple[Path, Path]] = set()
 
 
 def _ensure_dirs() -> None:
-    FILES_DIR.mkdir(parents=True, exist_ok=True)
-    if not DB_PATH.exists():
-        conn = sqlite3.connect(DB_PATH)
+    """Создаёт каталоги и схему один раз на процесс (для текущих путей)."""
+    paths = (FILES_DIR, DB_PATH)
+    if paths in _initialized:
+        return
+    with _init_lock:
+        if paths in _initialized:
+            return
+        FILES_DIR.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(DB_PATH, timeout=30)
         try:
+            conn.execute("PRAGMA journal_mode=WAL")
             conn.execute(
                 """
                 CREATE TABLE IF NOT EXISTS links (
@@ -33,70 +84,414 @@ def _ensure_dirs() -> None:
                 )
                 """
             )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(links)")}
+            # Старые БД: добавляем колонки; у прежних записей created_at неизвестен
+            if "created_at" not in columns:
+                conn.execute("ALTER TABLE links ADD COLUMN created_at REAL")
+            if "expires_at" not in columns:
+                conn.execute("ALTER TABLE links ADD COLUMN expires_at REAL")
+            if "exhausted_at" not in columns:
+                conn.execute("ALTER TABLE links ADD COLUMN exhausted_at REAL")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS links_exhausted ON links(token) WHERE remaining <= 0"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS links_expires ON links(expires_at) "
+                "WHERE expires_at IS NOT NULL"
+            )
+            # По пути считаются ссылки на файл: один файл может принадлежать многим ссылкам
+            conn.execute("CREATE INDEX IF NOT EXISTS links_path ON links(path)")
             conn.commit()
         finally:
             conn.close()
+        _initialized.add(paths)
 
 
-def _conn() -> sqlite3.Connection:
-    _ensure_dirs()
-    conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None)
-    conn.execute("PRAGMA journal_mode=WAL")
-    return conn
+class _ConnectionPool:
+    """Не больше ``size`` соединений с БД, общих для всех потоков процесса.
+
+    Flask-сервер ссылок (werkzeug) обрабатывает каждый запрос в новом потоке,
+    поэтому соединение «на поток» открывалось бы заново на каждый просмотр.
+    Соединение берётся на время одного запроса и возвращается вместе с кэшем
+    подготовленных запросов (sqlite3 держит его на уровне соединения).
+    ``SimpleQueue`` реализована на C: взять и вернуть соединение — доли
+    микросекунды, без заметной цены для долгоживущих потоков.
+    """
+
+    def __init__(self, path: Path, size: int) -> None:
+        self.path = path
+        self.size = size
+        self._idle: queue.SimpleQueue[sqlite3.Connection] = queue.SimpleQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def _open(self) -> sqlite3.Connection:
+        # check_same_thread=False: соединение переходит между потоками, но в каждый
+        # момент им пользуется только взявший его поток
+        conn = sqlite3.connect(
+            self.path,
+            timeout=30,
+            isolation_level=None,
+            cached_statements=64,
+            check_same_thread=False,
+        )
+        # WAL + synchronous=NORMAL: без fsync на каждый коммит; при сбое питания можно
+        # потерять последние коммиты, но не целостность БД
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA cache_size=-8192")  # 8 МБ
+        conn.execute("PRAGMA mmap_size=67108864")  # 64 МБ
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def get(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_open = self._opened < self.size
+            if can_open:
+                self._opened += 1
+        if not can_open:
+            return self._idle.get()  # все соединения заняты — ждём первое вернувшееся
+        try:
+            return self._open()
+        except BaseException:
+            with self._lock:
+                self._opened -= 1
+            raise
+
+    def put(self, conn: sqlite3.Connection) -> None:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        self._idle.put(conn)
+
+
+_pools: dict[Path, _ConnectionPool] = {}
+
+
+class _conn:
+    """Соединение из пула процесса на время ``with`` (для текущего ``DB_PATH``).
+
+    Класс, а не ``@contextmanager``: генератор стоил бы лишние микросекунды на
+    каждом просмотре.
+    """
+
+    __slots__ = ("_pool", "_c")
+
+    def __init__(self) -> None:
+        pool = _pools.get(DB_PATH)
+        if pool is None:
+            _ensure_dirs()
+            with _init_lock:
+                pool = _pools.setdefault(DB_PATH, _ConnectionPool(DB_PATH, POOL_SIZE))
+        self._pool = pool
+
+    def __enter__(self) -> sqlite3.Connection:
+        self._c = self._pool.get()
+        return self._c
+
+    def __exit__(self, *exc: object) -> None:
+        self._pool.put(self._c)
+
+
+@contextmanager
+def _transaction() -> Iterator[sqlite3.Connection]:
+    """Явная транзакция (``BEGIN IMMEDIATE`` сразу берёт запись)."""
+    with _conn() as c:
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            yield c
+        except BaseException:
+            c.execute("ROLLBACK")
+            raise
+        c.execute("COMMIT")
+
+
+def _write_atomic(path: Path, content: bytes) -> None:
+    """Пишет во временный файл рядом и переименовывает: читатель никогда не увидит
+    недописанный файл."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.{secrets.token_hex(4)}.tmp")
+    try:
+        tmp.write_bytes(content)
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+def content_path(content: bytes, suffix: str = ".jpg") -> Path:
+    """Путь файла по SHA-256 содержимого: ``files/ab/cd/abcd….jpg``.
+
+    Две ступени подкаталогов по 256 держат каталоги небольшими даже при
+    миллионах файлов.
+    """
+    digest = hashlib.sha256(content).hexdigest()
+    return FILES_DIR / digest[:2] / digest[2:4] / f"{digest}{suffix}"
 
 
-def save_file(content: bytes) -> Path:
+def save_file(content: bytes, suffix: str = ".jpg") -> Path:
+    """Сохраняет содержимое в адресуемое по хэшу хранилище.
+
+    Одинаковые рендеры получают один и тот же файл; повторная запись не нужна.
+    """
     _ensure_dirs()
-    filename = secrets.token_urlsafe(12) + ".jpg"
-    path = FILES_DIR / filename
-    path.write_bytes(content)
+    path = content_path(content, suffix)
+    if not path.exists():
+        _write_atomic(path, content)
     return path
 
 
-def create_link(content: bytes, max_views: int) -> Link:
+def _file_family(path: Path) -> list[Path]:
+    """Файл и его перекодированные варианты (см. ``encoders.write_variants``)."""
+    return [path, *{path.with_suffix(p.extension) for p in PROFILES.values()} - {path}]
+
+
+def _drop_unreferenced(c: sqlite3.Connection, paths: Iterable[str]) -> tuple[int, int]:
+    """Удаляет с диска файлы, на которые больше не ссылается ни одна запись.
+
+    Вызывается внутри транзакции, поэтому не пересекается с ``create_link``,
+    который в это время мог бы сослаться на тот же файл. Возвращает число
+    удалённых файлов и освобождённые байты.
+    """
+    files = freed = 0
+    for p in paths:
+        if c.execute("SELECT 1 FROM links WHERE path = ? LIMIT 1", (p,)).fetchone():
+            continue
+        for f in _file_family(Path(p)):
+            try:
+                size = f.stat().st_size
+                f.unlink()
+            except FileNotFoundError:
+                continue
+            files += 1
+            freed += size
+    return files, freed
+
+
+def _insert_link(
+    c: sqlite3.Connection, path: Path, max_views: int, ttl: Optional[float]
+) -> Link:
     if max_views <= 0:
         max_views = 1
-    path = save_file(content)
+    if ttl is None:
+        ttl = DEFAULT_TTL
     token = secrets.token_urlsafe(16)
-    with _conn() as c:
-        c.execute(
-            "INSERT INTO links(token, path, remaining) VALUES (?, ?, ?)",
-            (token, str(path), max_views),
-        )
-    return Link(token=token, path=path, remaining=max_views)
+    now = time.time()
+    expires_at = now + ttl if ttl > 0 else None
+    c.execute(
+        "INSERT INTO links(token, path, remaining, created_at, expires_at) VALUES (?, ?, ?, ?, ?)",
+        (token, str(path), max_views, now, expires_at),
+    )
+    return Link(token=token, path=path, remaining=max_views, expires_at=expires_at)
+
+
+def create_link(
+    content: bytes,
+    max_views: int,
+    suffix: str = ".jpg",
+    ttl: Optional[float] = None,
+) -> Link:
+    """Сохраняет файл и создаёт ссылку на ``max_views`` просмотров.
+
+    ``ttl`` — срок жизни в секундах (по умолчанию ``LINK_TTL``; 0 — бессрочно).
+    Просроченная ссылка не открывается, даже если просмотры остались.
+    """
+    with span("link_create"):
+        path = save_file(content, suffix)
+        with _transaction() as c:
+            link = _insert_link(c, path, max_views, ttl)
+            # Файл мог удалить сборщик между save_file и INSERT — тогда пишем заново
+            if not path.exists():
+                _write_atomic(path, content)
+    return link
+
+
+def link_existing(path: Path, max_views: int, ttl: Optional[float] = None) -> Optional[Link]:
+    """Создаёт ссылку на уже сохранённый файл; ``None``, если файла больше нет.
+
+    Проверка и вставка — в одной транзакции записи, поэтому сборщик не удалит
+    файл между ними.
+    """
+    _ensure_dirs()
+    with _transaction() as c:
+        if not path.exists():
+            return None
+        return _insert_link(c, path, max_views, ttl)
+
+
+def discard_files(paths: Iterable[Path]) -> Reclaimed:
+    """Удаляет сохранённые файлы, на которые так и не сослалась ни одна ссылка
+    (например, результат предварительного рендера, который не понадобился)."""
+    with _transaction() as c:
+        files, freed = _drop_unreferenced(c, [str(p) for p in paths])
+    return Reclaimed(files=files, bytes=freed)
+
+
+def delete_links(tokens: Iterable[str]) -> Reclaimed:
+    """Удаляет ссылки, которые так и не попали к пользователю, и ставшие ненужными файлы."""
+    result = Reclaimed()
+    with _transaction() as c:
+        paths: set[str] = set()
+        for token in tokens:
+            for (path,) in c.execute("DELETE FROM links WHERE token = ? RETURNING path", (token,)):
+                paths.add(path)
+                result.rows += 1
+        result.files, result.bytes = _drop_unreferenced(c, paths)
+    return result
 
 
 def fetch_link(token: str) -> Optional[Link]:
     with _conn() as c:
         row = c.execute(
-            "SELECT token, path, remaining FROM links WHERE token = ?",
-            (token,),
+            "SELECT token, path, remaining, expires_at FROM links "
+            "WHERE token = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (token, time.time()),
         ).fetchone()
     if not row:
         return None
-    return Link(token=row[0], path=Path(row[1]), remaining=int(row[2]))
+    return Link(token=row[0], path=Path(row[1]), remaining=int(row[2]), expires_at=row[3])
 
 
 def consume_view(token: str) -> Optional[Link]:
-    """Атомарно уменьшает счётчик и отдаёт ссылку; если 0 — удаляет запись."""
+    """Атомарно уменьшает счётчик и отдаёт ссылку.
+
+    Одна инструкция ``UPDATE ... RETURNING``: проверка и уменьшение не разделены,
+    поэтому при конкурентных запросах (в т.ч. из разных процессов) ссылка
+    открывается ровно ``max_views`` раз. Исчерпанная или просроченная запись
+    остаётся в таблице и удаляется позже — см. :func:`reap_exhausted` и
+    :func:`reap_expired`; момент последнего просмотра пишется в ``exhausted_at``.
+    """
+    now = time.time()
+    # fetchall, а не fetchone: инструкция должна выполниться до конца и снять блокировку
     with _conn() as c:
-        cur = c.execute(
-            "SELECT path, remaining FROM links WHERE token = ?",
-            (token,),
+        rows = c.execute(
+            "UPDATE links SET remaining = remaining - 1, "
+            "exhausted_at = CASE WHEN remaining <= 1 THEN ? ELSE exhausted_at END "
+            "WHERE token = ? AND remaining > 0 AND (expires_at IS NULL OR expires_at > ?) "
+            "RETURNING path, remaining",
+            (now, token, now),
+        ).fetchall()
+    if not rows:
+        return None
+    path, remaining = rows[0]
+    return Link(token=token, path=Path(path), remaining=int(remaining))
+
+
+def subtract_views(batch: list[tuple[int, str]]) -> None:
+    """Списывает просмотры пачкой ``(сколько, token)`` одной транзакцией."""
+    now = time.time()
+    with _transaction() as c:
+        c.executemany(
+            "UPDATE links SET remaining = MAX(remaining - ?, 0), "
+            "exhausted_at = CASE WHEN remaining - ? <= 0 "
+            "THEN COALESCE(exhausted_at, ?) ELSE exhausted_at END "
+            "WHERE token = ?",
+            [(n, n, now, token) for n, token in batch],
         )
-        row = cur.fetchone()
-        if not row:
-            return None
-        path, remaining = Path(row[0]), int(row[1])
-        if remaining <= 0:
-            c.execute("DELETE FROM links WHERE token = ?", (token,))
-            return None
-        remaining -= 1
-        if remaining == 0:
-            c.execute("DELETE FROM links WHERE token = ?", (token,))
-        else:
-            c.execute(
-                "UPDATE links SET remaining = ? WHERE token = ?",
-                (remaining, token),
-            )
-    return Link(token=token, path=path, remaining=remaining)
+
+
+def _reap(
+    where: str, params: tuple[object, ...], limit: int, on_removed: Optional[ReapHook]
+) -> Reclaimed:
+    with _transaction() as c:
+        rows = c.execute(
+            f"DELETE FROM links WHERE token IN (SELECT token FROM links WHERE {where} LIMIT ?) "
+            "RETURNING token, path",
+            (*params, limit),
+        ).fetchall()
+        files, freed = _drop_unreferenced(c, {row[1] for row in rows})
+    if rows and on_removed is not None:
+        on_removed([(token, Path(path)) for token, path in rows])
+    return Reclaimed(rows=len(rows), files=files, bytes=freed)
+
+
+def reap_exhausted(
+    limit: int = 100,
+    on_removed: Optional[ReapHook] = None,
+    grace: float = EXHAUSTED_GRACE,
+) -> Reclaimed:
+    """Удаляет до ``limit`` записей, исчерпанных больше ``grace`` секунд назад, и
+    ставшие ненужными файлы.
+
+    Вызывается сборщиком (:class:`bot.link_gc.LinkSweeper`). Без паузы последний,
+    законный просмотр мог бы получить 404: сборщик другого процесса убрал бы запись
+    между ``consume_view`` и чтением файла сервером ссылок. Записи старых версий без
+    ``exhausted_at`` удаляются сразу.
+    """
+    return _reap(
+        "remaining <= 0 AND (exhausted_at IS NULL OR exhausted_at <= ?)",
+        (time.time() - grace,),
+        limit,
+        on_removed,
+    )
+
+
+def reap_expired(
+    limit: int = 100, now: Optional[float] = None, on_removed: Optional[ReapHook] = None
+) -> Reclaimed:
+    """Удаляет до ``limit`` просроченных записей и ставшие ненужными файлы."""
+    return _reap(
+        "expires_at IS NOT NULL AND expires_at <= ?",
+        (time.time() if now is None else now,),
+        limit,
+        on_removed,
+    )
+
+
+def _stored_files() -> Iterator[Path]:
+    """Файлы хранилища: шардированные и оставшиеся в корне от старой схемы."""
+    for entry in os.scandir(FILES_DIR):
+        if entry.is_file():
+            yield Path(entry.path)
+        elif entry.is_dir():
+            for root, _, names in os.walk(entry.path):
+                for name in names:
+                    yield Path(root, name)
+
+
+def reap_orphan_files(limit: int = 500, grace: float = 300.0) -> Reclaimed:
+    """Удаляет файлы, на которые не ссылается ни одна запись.
+
+    Такие файлы остаются от версий, которые не удаляли файлы вместе со ссылками,
+    и от прерванных записей (``*.tmp``). Файлы моложе ``grace`` секунд не трогаем:
+    ``create_link`` сохраняет файл до того, как вставит запись. Проверяется до
+    ``limit`` файлов на транзакцию, чтобы не держать блокировку записи долго.
+    """
+    _ensure_dirs()
+    deadline = time.time() - grace
+    result = Reclaimed()
+
+    def flush(batch: list[Path]) -> None:
+        with _transaction() as c:
+            for path in batch:
+                # Вариант (WebP/AVIF) нужен, пока жива запись на любой файл с тем же именем
+                family = [path] if path.suffix == ".tmp" else _file_family(path)
+                if any(
+                    c.execute("SELECT 1 FROM links WHERE path = ? LIMIT 1", (str(f),)).fetchone()
+                    for f in family
+                ):
+                    continue
+                try:
+                    size = path.stat().st_size
+                    path.unlink()
+                except FileNotFoundError:
+                    continue
+                result.files += 1
+                result.bytes += size
+
+    batch: list[Path] = []
+    for path in _stored_files():
+        try:
+            if path.stat().st_mtime > deadline:
+                continue
+        except FileNotFoundError:
+            continue
+        batch.append(path)
+        if len(batch) >= limit:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+    return result
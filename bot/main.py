@@ -1,21 +1,51 @@
 from __future__ import annotations
 
-import io
+import asyncio
+import logging
+import multiprocessing
 import os
-from typing import Final
+import signal
+import socket
+from dataclasses import replace
+from pathlib import Path
+from typing import Final, Optional
+from urllib.parse import urlsplit
 
 from aiogram import Bot, Dispatcher, F, Router
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import CommandStart, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import BotCommand, BufferedInputFile, Message
-
-from .config import load_settings
-from .image_utils import render_watermark_tiled
-from .links import create_link
+from aiogram.types import BotCommand, BufferedInputFile, InputMediaPhoto, Message
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+from .albums import AlbumParts, create_albums
+from .config import Settings, load_settings
+from .downloads import MAX_DOWNLOAD_BYTES, DownloadRejected, download_image
+from .encoders import LINK_VARIANTS, EncoderProfile, get_profile, write_variants
+from .fsm import create_storage
+from .image_utils import MAX_OUTPUT_EDGE, render_watermark_tiled, render_watermark_tiled_batch
+from .links import Link, create_link, delete_links, link_existing, save_file
+from .metrics import (
+    FSM_ENTRIES,
+    PRERENDERS,
+    QUEUE_DEPTH,
+    RENDER_IN_FLIGHT,
+    add_aiohttp_routes,
+    monitor_loop_lag,
+    span,
+)
+from .prerender import Artifact, Prerenders, Result, Signature
+from .render_service import RenderBusyError, RenderService
+from .sent_cache import SentPhotoCache, sent_key
+from .throttling import ThrottlingMiddleware
+
+logger = logging.getLogger(__name__)
 
 
 class Awaiting(StatesGroup):
@@ -43,43 +73,260 @@ async def on_help(message: Message) -> None:
         "— Пришли фото без подписи\n"
         "— Затем пришли текст — нанесу водяной знак плиткой\n"
         "— Затем укажи число X — ссылка откроется X раз\n\n"
-        "Можно сразу фото с подписью: подпись станет водяным знаком.",
+        "Можно сразу фото с подписью: подпись станет водяным знаком.\n"
+        "Альбом (до 10 фото) обработаю целиком: знак на всех фото и ссылка на каждое.",
     )
 
 
+_TOO_LARGE = "📦 Фото слишком большое. Пришли снимок поменьше, пожалуйста."
+
+
+def _photo_ref(message: Message) -> list:
+    """Что храним в состоянии о фото: ``[file_id, file_size, file_unique_id]``."""
+    largest = message.photo[-1]
+    return [largest.file_id, largest.file_size, largest.file_unique_id]
+
+
+def _sent_key(uid: str, text: str, profile: EncoderProfile) -> str:
+    return sent_key(uid, text, "tiled", profile.name, MAX_OUTPUT_EDGE)
+
+
+def _signature(photos: list[list], text: str, profile: EncoderProfile) -> Signature:
+    return tuple(uid for _, _, uid in photos), text, profile.name
+
+
+async def _render(
+    bot: Bot, renders: RenderService, photos: list[list], text: str, profile: EncoderProfile
+) -> Result:
+    """Скачивает фото, накладывает водяной знак и сохраняет результат.
+
+    Файлы сохраняются последним шагом, в потоке: хэширование и запись мегабайтов
+    не задерживают event loop. Если рендер отменили во время записи, файлы без
+    ссылок уберёт сборщик сирот.
+    """
+    # Потоком в один буфер; размер и заголовок проверяются по ходу загрузки
+    raws = await asyncio.gather(
+        *(download_image(bot, file_id, size) for file_id, size, _ in photos)
+    )
+
+    # Рендерим водяной знак в пуле процессов, чтобы не блокировать event loop.
+    # Альбом — одно задание: шрифт, плитка и слой строятся один раз на все кадры
+    if len(raws) == 1:
+        results = [await renders.run(render_watermark_tiled, raws[0], text, None, profile.name)]
+    else:
+        results = await renders.run(render_watermark_tiled_batch, raws, text, None, profile.name)
+    paths = await asyncio.to_thread(
+        lambda: [save_file(result, profile.extension) for result in results]
+    )
+    return {
+        uid: Artifact(result, path) for (_, _, uid), result, path in zip(photos, results, paths)
+    }
+
+
+async def _prerender(
+    message: Message,
+    state: FSMContext,
+    renders: RenderService,
+    sent: SentPhotoCache,
+    prerenders: Prerenders,
+    photos: list[list],
+    text: str,
+) -> None:
+    """Начинает рендер, пока пользователь выбирает число открытий.
+
+    Только на свободных воркерах: предварительный рендер не должен занимать
+    очередь перед теми, кто уже прислал число.
+    """
+    if not prerenders.enabled:
+        return
+    profile = get_profile()
+    todo = [
+        photo for photo in photos if not await sent.contains(_sent_key(photo[2], text, profile))
+    ]
+    if not todo:
+        return
+    if renders.in_flight >= renders.workers:
+        PRERENDERS.inc(result="skipped")
+        return
+    prerenders.start(
+        state.key,
+        _signature(photos, text, profile),
+        lambda: _render(message.bot, renders, todo, text, profile),
+    )
+
+
+_background: set[asyncio.Task[None]] = set()
+
+
+def _encode_variants(renders: RenderService, paths: list[Path]) -> None:
+    """Кодирует файлы ссылок в форматы ``LINK_VARIANTS`` в фоне, после ответа.
+
+    Сервер ссылок отдаёт вариант, только когда он готов. Как и предварительный
+    рендер — только на свободных воркерах; иначе браузер получит оригинал.
+    """
+    if not LINK_VARIANTS or not paths or renders.in_flight >= renders.workers:
+        return
+
+    async def run() -> None:
+        try:
+            await renders.run(write_variants, paths, LINK_VARIANTS)
+        except Exception:
+            logger.warning("Не удалось закодировать варианты для ссылок", exc_info=True)
+
+    task = asyncio.create_task(run())
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+
+
+async def _collect_album(
+    group_id: str,
+    message: Message,
+    state: FSMContext,
+    albums: AlbumParts,
+    renders: RenderService,
+    sent: SentPhotoCache,
+    prerenders: Prerenders,
+) -> None:
+    album = await albums.collect(group_id)
+    if album is None:
+        return  # альбом собрал и ответил другой процесс
+    photos, caption = album
+    if any(size and size > MAX_DOWNLOAD_BYTES for _, size, _ in photos):
+        await message.answer(_TOO_LARGE)
+        return
+    await state.set_data({"album": photos, "text": caption})
+    if caption:
+        await state.set_state(Awaiting.views)
+        await _prerender(message, state, renders, sent, prerenders, photos, caption)
+        await message.answer("🔢 Сколько открытий у каждой ссылки? Укажи число (по умолчанию 3).")
+    else:
+        await state.set_state(Awaiting.caption)
+        await message.answer(
+            f"✍️ Пришли текст для водяного знака — нанесу на все {len(photos)} фото."
+        )
+
+
+@router.message(F.photo & F.media_group_id)
+async def on_album_photo(
+    message: Message,
+    state: FSMContext,
+    albums: AlbumParts,
+    renders: RenderService,
+    sent: SentPhotoCache,
+    prerenders: Prerenders,
+) -> None:
+    group_id = message.media_group_id
+    assert group_id is not None
+    first = await albums.add(
+        group_id, message.message_id, _photo_ref(message), message.caption or ""
+    )
+    if not first:
+        return
+    prerenders.cancel(state.key)
+    # Не ждём в обработчике: остальные части альбома обрабатываются следом в том же чате
+    task = asyncio.create_task(
+        _collect_album(group_id, message, state, albums, renders, sent, prerenders)
+    )
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+
+
 @router.message(F.photo & F.caption)
-async def on_photo_with_caption(message: Message, state: FSMContext) -> None:
+async def on_photo_with_caption(
+    message: Message,
+    state: FSMContext,
+    renders: RenderService,
+    sent: SentPhotoCache,
+    prerenders: Prerenders,
+) -> None:
+    # В состоянии храним только file_id; рендер начинается в фоне, пока ждём число
     largest = message.photo[-1]
-    buf = io.BytesIO()
-    await message.bot.download(largest, destination=buf)
-    await state.update_data(raw_image=buf.getvalue(), text=message.caption or "")
+    if largest.file_size and largest.file_size > MAX_DOWNLOAD_BYTES:
+        prerenders.cancel(state.key)
+        await message.answer(_TOO_LARGE)
+        return
+    photo, text = _photo_ref(message), message.caption or ""
+    await state.set_data({"photo": photo, "text": text})
     await state.set_state(Awaiting.views)
+    await _prerender(message, state, renders, sent, prerenders, [photo], text)
     await message.answer("🔢 Сколько открытий ссылки? Укажи число (по умолчанию 3).")
 
 
 @router.message(F.photo)
-async def on_photo(message: Message, state: FSMContext) -> None:
+async def on_photo(message: Message, state: FSMContext, prerenders: Prerenders) -> None:
+    prerenders.cancel(state.key)
     largest = message.photo[-1]
-    buf = io.BytesIO()
-    await message.bot.download(largest, destination=buf)
-    await state.update_data(raw_image=buf.getvalue())
+    if largest.file_size and largest.file_size > MAX_DOWNLOAD_BYTES:
+        await message.answer(_TOO_LARGE)
+        return
+    await state.set_data({"photo": _photo_ref(message)})
     await state.set_state(Awaiting.caption)
     await message.answer("✍️ Пришли текст для водяного знака.")
 
 
 @router.message(StateFilter(Awaiting.caption))
-async def on_caption(message: Message, state: FSMContext) -> None:
-    await state.update_data(text=message.text or "")
+async def on_caption(
+    message: Message,
+    state: FSMContext,
+    renders: RenderService,
+    sent: SentPhotoCache,
+    prerenders: Prerenders,
+) -> None:
+    text = message.text or ""
+    data = await state.update_data(text=text)
     await state.set_state(Awaiting.views)
+    photos: list[list] = data.get("album") or ([data["photo"]] if data.get("photo") else [])
+    if photos:
+        await _prerender(message, state, renders, sent, prerenders, photos, text)
     await message.answer("🔢 Сколько открытий ссылки? Укажи число (по умолчанию 3).")
 
 
-@router.message(StateFilter(Awaiting.views))
-async def on_views(message: Message, state: FSMContext) -> None:
+def _create_links(
+    hits: list[Optional[tuple[str, Path]]],
+    rendered: dict[int, Artifact],
+    x: int,
+    profile: EncoderProfile,
+) -> Optional[list[Link]]:
+    """Создаёт ссылки на все фото (вызывается в потоке: запись в БД и файлы).
+
+    ``None`` — сборщик убрал файл отправленного раньше результата между проверкой
+    и вставкой; созданные к этому моменту записи удаляются, следующая попытка
+    отрендерит файл заново.
+    """
+    links: list[Link] = []
+    try:
+        for i, hit in enumerate(hits):
+            artifact = rendered.get(i)
+            if artifact is not None:
+                # Файл мог убрать сборщик — тогда пишем заново
+                link = link_existing(artifact.path, x) or create_link(
+                    artifact.content, x, suffix=profile.extension
+                )
+            else:
+                assert hit is not None
+                link = link_existing(hit[1], x)
+            if link is None:
+                delete_links([link.token for link in links])
+                return None
+            links.append(link)
+    except BaseException:
+        delete_links([link.token for link in links])
+        raise
+    return links
+
+
+@router.message(StateFilter(Awaiting.views), flags={"heavy": True})
+async def on_views(
+    message: Message,
+    state: FSMContext,
+    renders: RenderService,
+    sent: SentPhotoCache,
+    prerenders: Prerenders,
+) -> None:
     data = await state.get_data()
-    raw: bytes | None = data.get("raw_image")
+    photos: list[list] = data.get("album") or ([data["photo"]] if data.get("photo") else [])
     text: str = data.get("text", "")
-    if raw is None:
+    if not photos:
         await state.clear()
         await message.answer("Не нашёл изображение в состоянии. Отправь фото ещё раз, пожалуйста.")
         return
@@ -92,22 +339,95 @@ async def on_views(message: Message, state: FSMContext) -> None:
     if x <= 0:
         x = 1
 
-    # Рендерим водяной знак
-    watermarked = render_watermark_tiled(raw, text)
-
-    # Сохраняем файл и создаём токен
-    link = create_link(watermarked, x)
+    # Уже отправлявшийся результат (тот же исходник, подпись и параметры) не загружаем
+    # заново: фото уходит по file_id. Рендер нужен, только если файла для ссылки уже нет
+    profile = get_profile()
+    keys = [_sent_key(uid, text, profile) for _, _, uid in photos]
+    hits = [await sent.get(key) for key in keys]
+    file_ids: list[str | None] = [hit[0] if hit else None for hit in hits]
+    todo = [i for i, hit in enumerate(hits) if hit is None or not hit[1].exists()]
+
+    # Записи ссылок создаются, только когда готовы все файлы: ранний выход ничего
+    # не оставляет в БД
+    rendered: dict[int, Artifact] = {}
+    if todo:
+        # Обычно результат уже готов (или почти готов) после шага с подписью
+        done = await prerenders.take(state.key, _signature(photos, text, profile))
+        missing = [photos[i] for i in todo if photos[i][2] not in done]
+        if missing:
+            try:
+                done |= await _render(message.bot, renders, missing, text, profile)
+            except DownloadRejected:
+                prerenders.release(done)
+                await state.clear()
+                await message.answer(
+                    "📦 Не получилось принять фото: оно слишком большое или повреждено."
+                )
+                return
+            except RenderBusyError:
+                prerenders.release(done)
+                await message.answer("⏳ Сейчас много запросов. Пришли число ещё раз через минуту.")
+                return
+            except TimeoutError:
+                prerenders.release(done)
+                await message.answer("⌛ Не успел обработать изображение. Попробуй ещё раз.")
+                return
+        rendered = {i: done[photos[i][2]] for i in todo}
+
+    links = await asyncio.to_thread(_create_links, hits, rendered, x, profile)
+    if links is None:
+        await message.answer("⚠️ Не получилось подготовить ссылку. Пришли число ещё раз.")
+        return
 
+    media = [
+        file_ids[i]
+        or BufferedInputFile(rendered[i].content, filename=f"result{i + 1}{profile.extension}")
+        for i in range(len(photos))
+    ]
     base_url = os.getenv("PUBLIC_BASE_URL", "http://localhost:8080").rstrip("/")
-    url = f"{base_url}/v/{link.token}"
+    urls = [f"{base_url}/v/{link.token}" for link in links]
 
-    await message.answer_photo(photo=BufferedInputFile(watermarked, filename="result.jpg"))
-    await message.answer(
-        f"🔗 Ссылка: {url}\n"
-        f"Осталось открытий: {x}\n"
-        "Подсказка: чтобы дать публичную ссылку с локального ПК — используй cloudflared/ngrok.",
-    )
+    try:
+        with span("upload"):
+            if len(media) == 1:
+                sent_messages = [await message.answer_photo(photo=media[0])]
+            else:
+                sent_messages = await message.answer_media_group(
+                    [InputMediaPhoto(media=item) for item in media]
+                )
+    except TelegramBadRequest:
+        # Пользователь не получил ни фото, ни ссылок: созданные записи не нужны
+        await asyncio.to_thread(delete_links, [link.token for link in links])
+        if not any(file_ids):
+            raise
+        # Сохранённый file_id больше не принимается — забываем его и рендерим заново
+        for i, file_id in enumerate(file_ids):
+            if file_id:
+                await sent.forget(keys[i])
+        await message.answer("⚠️ Не получилось отправить результат. Пришли число ещё раз.")
+        return
+    except BaseException:
+        await asyncio.to_thread(delete_links, [link.token for link in links])
+        raise
+
+    if len(media) == 1:
+        await message.answer(
+            f"🔗 Ссылка: {urls[0]}\n"
+            f"Осталось открытий: {x}\n"
+            "Подсказка: чтобы дать публичную ссылку с локального ПК — используй cloudflared/ngrok.",
+        )
+    else:
+        await message.answer(
+            "🔗 Ссылки:\n"
+            + "\n".join(f"{i}. {url}" for i, url in enumerate(urls, 1))
+            + f"\nОткрытий у каждой: {x}",
+        )
+    for i in todo:
+        if sent_messages[i].photo:
+            await sent.put(keys[i], sent_messages[i].photo[-1].file_id, links[i].path)
     await state.clear()
+    # Новые файлы; у отправлявшихся раньше варианты уже есть
+    _encode_variants(renders, list({links[i].path for i in todo}))
 
 
 @router.message(StateFilter(None))
@@ -116,21 +436,198 @@ async def on_text_without_photo(message: Message) -> None:
         await message.answer("Сначала отправь фото, затем текст и число открытий ✍️")
 
 
-async def main() -> None:
-    settings = load_settings()
-
-    bot = Bot(
+def _create_bot(settings: Settings) -> Bot:
+    # Свой адрес Bot API: локальный telegram-bot-api или тестовый стенд
+    session = None
+    if settings.api_url:
+        session = AiohttpSession(api=TelegramAPIServer.from_base(settings.api_url))
+    return Bot(
         token=settings.bot_token,
+        session=session,
         default=DefaultBotProperties(parse_mode=ParseMode.HTML),
     )
-    dp = Dispatcher(storage=MemoryStorage())
-    dp.include_router(router)
 
-    if not settings.webhook_url:
+
+def create_dispatcher(settings: Settings) -> Dispatcher:
+    dp = Dispatcher(storage=create_storage(settings))
+    dp.include_router(router)
+    dp["throttling"] = ThrottlingMiddleware(
+        rate_per_min=settings.rate_limit,
+        burst=settings.rate_burst,
+        max_inflight=settings.max_inflight,
+    )
+    dp.message.middleware(dp["throttling"])
+    dp["renders"] = RenderService(
+        workers=settings.render_workers,
+        max_queue=settings.render_queue,
+        timeout=settings.render_timeout,
+    )
+    dp["sent"] = SentPhotoCache()
+    dp["prerenders"] = Prerenders(ttl=settings.prerender_ttl)
+    dp["albums"] = create_albums(settings)
+
+    # Значения gauge считываются при каждом опросе /metrics
+    renders: RenderService = dp["renders"]
+    FSM_ENTRIES.set_function(dp.storage.entries)  # type: ignore[attr-defined]
+    RENDER_IN_FLIGHT.set_function(lambda: renders.in_flight)
+    QUEUE_DEPTH.set_function(lambda: renders.queued, queue="render")
+    QUEUE_DEPTH.set_function(lambda: len(dp["prerenders"]), queue="prerender")
+    return dp
+
+
+async def _serve_metrics(port: int) -> web.AppRunner:
+    """Отдельный сервер ``/metrics`` процесса на ``port``."""
+    app = web.Application()
+    add_aiohttp_routes(app)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", port).start()
+    logger.info("Метрики: http://0.0.0.0:%d/metrics", port)
+    return runner
+
+
+def _webhook_route(settings: Settings) -> tuple[str, str]:
+    """URL для Telegram и путь, на котором его слушаем (по умолчанию ``/webhook``)."""
+    parts = urlsplit(settings.webhook_url)
+    if parts.path.strip("/"):
+        return settings.webhook_url, parts.path
+    return settings.webhook_url.rstrip("/") + "/webhook", "/webhook"
+
+
+async def _serve_webhook(
+    settings: Settings, bot: Bot, dp: Dispatcher, stop: asyncio.Event, worker: int = 0
+) -> None:
+    """Принимает апдейты aiohttp-сервером в текущем event loop до ``stop``.
+
+    Апдейт разбирается и обрабатывается в том же loop, где работает aiogram, —
+    без WSGI-потоков и передачи между потоками. Несколько процессов слушают
+    один порт через ``SO_REUSEPORT``, и ядро распределяет между ними соединения.
+
+    На общем порту ``/metrics`` отвечал бы случайный процесс, поэтому с
+    несколькими процессами процесс номер ``worker`` отдаёт метрики на своём
+    порту ``METRICS_PORT + worker``.
+    """
+    _, path = _webhook_route(settings)
+
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=settings.webhook_secret or None,
+    ).register(app, path=path)
+    setup_application(app, dp, bot=bot)
+    shared_port = settings.webhook_workers > 1
+    if not shared_port:
+        add_aiohttp_routes(app)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(
+        runner,
+        settings.webhook_host,
+        settings.webhook_port,
+        reuse_port=shared_port or None,
+    )
+    metrics: Optional[web.AppRunner] = None
+    lag = asyncio.create_task(monitor_loop_lag())
+    try:
+        if shared_port and settings.metrics_port:
+            metrics = await _serve_metrics(settings.metrics_port + worker)
+        await site.start()
+        logger.info("Webhook слушает %s:%d%s", settings.webhook_host, settings.webhook_port, path)
+        await stop.wait()
+    finally:
+        lag.cancel()
+        if metrics is not None:
+            await metrics.cleanup()
+        # Закрывает и сессию бота (обработчик подписан на on_shutdown)
+        await runner.cleanup()
+        dp["prerenders"].close()
+        dp["albums"].close()
+        dp["renders"].close()
+        dp["sent"].close()
+
+
+def _stop_on_signals(stop: asyncio.Event) -> None:
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
         try:
-            await bot.delete_webhook(drop_pending_updates=True)
-        except Exception:
-            pass
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass  # Windows: остаётся KeyboardInterrupt
+
+
+def _webhook_worker(settings: Settings, worker: int) -> None:
+    """Точка входа дополнительного webhook-процесса номер ``worker``."""
+    logging.basicConfig(level=logging.INFO)
+
+    async def run() -> None:
+        stop = asyncio.Event()
+        _stop_on_signals(stop)
+        bot, dp = _create_bot(settings), create_dispatcher(settings)
+        await _serve_webhook(settings, bot, dp, stop, worker)
+
+    asyncio.run(run())
+
+
+async def _run_webhook(settings: Settings) -> None:
+    workers = settings.webhook_workers
+    if workers > 1 and not hasattr(socket, "SO_REUSEPORT"):
+        logger.warning("SO_REUSEPORT недоступен — webhook работает в одном процессе")
+        workers = 1
+    if workers > 1 and settings.fsm_storage != "sqlite":
+        # Шаги одного диалога могут попасть в разные процессы
+        raise RuntimeError("WEBHOOK_WORKERS > 1 требует FSM_STORAGE=sqlite")
+    if workers > 1 and not settings.metrics_port:
+        logger.warning("WEBHOOK_WORKERS > 1: /metrics доступен только с METRICS_PORT")
+    settings = replace(settings, webhook_workers=workers)
+
+    url, _ = _webhook_route(settings)
+    bot = _create_bot(settings)
+    dp = create_dispatcher(settings)
+    await bot.set_webhook(
+        url,
+        secret_token=settings.webhook_secret or None,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+    await bot.set_my_commands(
+        [
+            BotCommand(command="start", description="Начать"),
+            BotCommand(command="help", description="Помощь"),
+        ]
+    )
+
+    ctx = multiprocessing.get_context("spawn")
+    procs = [
+        ctx.Process(target=_webhook_worker, args=(settings, i), name=f"webhook-{i}")
+        for i in range(1, workers)
+    ]
+    for proc in procs:
+        proc.start()
+    stop = asyncio.Event()
+    _stop_on_signals(stop)
+    try:
+        await _serve_webhook(settings, bot, dp, stop)
+    finally:
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            proc.join()
+
+
+async def main() -> None:
+    settings = load_settings()
+    if settings.webhook_url:
+        await _run_webhook(settings)
+        return
+
+    bot = _create_bot(settings)
+    dp = create_dispatcher(settings)
+
+    try:
+        await bot.delete_webhook(drop_pending_updates=True)
+    except Exception:
+        pass
 
     await bot.set_my_commands(
         [
@@ -139,7 +636,16 @@ async def main() -> None:
         ]
     )
 
+    metrics = await _serve_metrics(settings.metrics_port) if settings.metrics_port else None
+    lag = asyncio.create_task(monitor_loop_lag())
     try:
         await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
     finally:
+        lag.cancel()
+        if metrics is not None:
+            await metrics.cleanup()
+        dp["prerenders"].close()
+        dp["albums"].close()
+        dp["renders"].close()
+        dp["sent"].close()
         await bot.session.close()
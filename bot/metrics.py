@@ -0,0 +1,356 @@
+"""Метрики в текстовом формате Prometheus — без prometheus_client.
+
+Счётчики, гистограммы и «живые» gauge живут в памяти процесса; ``render()``
+отдаёт их в формате exposition 0.0.4 для ``/metrics``. Запись — один lock и
+несколько сложений, поэтому метрики включены всегда.
+
+- ``span(stage)`` — время этапа конвейера (download, decode, composite, encode,
+  link_create, upload, link_open…) в гистограмме ``photobot_stage_seconds``.
+  В процессах пула рендера замеры и приращения счётчиков (например, попадания
+  в кэши водяного знака) копятся и возвращаются вместе с результатом
+  (``call_with_spans``), чтобы попасть в метрики основного процесса.
+- ``monitor_loop_lag()`` — фоновая задача, меряющая задержку event loop.
+- ``sample_stacks()`` — выборочный профайлер: раз в ``1/hz`` секунды снимает стеки
+  всех потоков процесса и возвращает их в «folded»-формате для flamegraph.pl /
+  speedscope. Включается только явно (``METRICS_PROFILER=1``) и только на время
+  запроса.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import math
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter as _Tally
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Optional, Sequence
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# /debug/profile доступен, только если включён явно: стеки раскрывают внутренности
+PROFILER_ENABLED = os.getenv("METRICS_PROFILER", "").strip().lower() in ("1", "true", "yes")
+
+LabelKey = tuple[str, ...]
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self._lock = threading.Lock()
+        REGISTRY[name] = self
+
+    def _key(self, labels: dict[str, str]) -> LabelKey:
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def _samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        head = f"# HELP {self.name} {self.help}\n# TYPE {self.name} {self.kind}\n"
+        return head + "".join(line + "\n" for line in self._samples())
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        super().__init__(name, help, labels)
+        self._values: dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        if _counter_sink is not None:
+            _counter_sink.append((self.name, key, amount))
+            return
+        self._add(key, amount)
+
+    def _add(self, key: LabelKey, amount: float) -> None:
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self) -> Iterator[str]:
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Gauge(_Metric):
+    """Значение на момент опроса. ``set_function`` — считать его при каждом ``render``:
+    так глубина очереди или число записей не требуют обновления на горячем пути."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        super().__init__(name, help, labels)
+        self._values: dict[LabelKey, float] = {}
+        self._functions: dict[LabelKey, Callable[[], float]] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        self._values[self._key(labels)] = value
+
+    def set_function(self, fn: Callable[[], float], **labels: str) -> None:
+        self._functions[self._key(labels)] = fn
+
+    def _samples(self) -> Iterator[str]:
+        values = dict(self._values)
+        for key, fn in list(self._functions.items()):
+            try:
+                values[key] = fn()
+            except Exception:
+                continue  # источник уже закрыт — просто не показываем
+        for key, value in values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+# Секунды: от миллисекунды (шаг FSM) до минуты (таймаут рендера)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # По ключу меток: счётчики по корзинам (последняя — +Inf), сумма
+        self._data: dict[LabelKey, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            data = self._data.get(key)
+            if data is None:
+                data = self._data[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            data[0][i] += 1
+            data[1][0] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def count(self, **labels: str) -> int:
+        data = self._data.get(self._key(labels))
+        return sum(data[0]) if data else 0
+
+    def _samples(self) -> Iterator[str]:
+        with self._lock:
+            items = [(key, list(counts), total[0]) for key, (counts, total) in self._data.items()]
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, n in zip((*self.buckets, math.inf), counts):
+                cumulative += n
+                le = 'le="' + _format_value(bound) + '"'
+                labels = _format_labels(self.labelnames, key, le)
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+REGISTRY: dict[str, _Metric] = {}
+
+
+def render() -> str:
+    """Все метрики процесса в текстовом формате Prometheus."""
+    return "".join(metric.render() for metric in list(REGISTRY.values()))
+
+
+# --- метрики приложения ---
+
+STAGE_SECONDS = Histogram(
+    "photobot_stage_seconds", "Длительность этапов обработки фото и отдачи ссылок", ["stage"]
+)
+RENDERS = Counter(
+    "photobot_renders_total", "Задания рендера по результату (ok, busy, timeout, error)", ["result"]
+)
+VIEWS = Counter("photobot_link_views_total", "Запросы /v/<token> по HTTP-статусу", ["status"])
+PRERENDERS = Counter(
+    "photobot_prerenders_total",
+    "Предварительные рендеры по исходу (hit, miss, failed, superseded, expired, skipped…)",
+    ["result"],
+)
+WATERMARK_CACHE = Counter(
+    "photobot_watermark_cache_total",
+    "Обращения к кэшам водяного знака в процессах рендера (tile, layer × hit, miss)",
+    ["cache", "result"],
+)
+FSM_ENTRIES = Gauge("photobot_fsm_entries", "Записей в хранилище состояний диалогов")
+RENDER_IN_FLIGHT = Gauge("photobot_render_in_flight", "Заданий рендера в работе и в очереди")
+QUEUE_DEPTH = Gauge("photobot_queue_depth", "Ожидающих задач в очереди", ["queue"])
+LOOP_LAG = Histogram(
+    "photobot_event_loop_lag_seconds",
+    "Насколько позже срока просыпается задача в event loop",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+
+
+# --- этапы ---
+
+# В процессе пула рендера замеры и приращения счётчиков копятся здесь и уходят
+# в основной процесс
+_span_sink: Optional[list[tuple[str, float]]] = None
+_counter_sink: Optional[list[tuple[str, LabelKey, float]]] = None
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """Замеряет блок как этап ``stage`` (можно оборачивать и ``await``)."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - t0
+        if _span_sink is not None:
+            _span_sink.append((stage, elapsed))
+        else:
+            STAGE_SECONDS.observe(elapsed, stage=stage)
+
+
+Report = tuple[list[tuple[str, float]], list[tuple[str, LabelKey, float]]]
+
+
+def call_with_spans(fn: Callable[..., Any], *args: Any) -> tuple[Any, Report]:
+    """Выполняет ``fn`` в воркере пула и возвращает результат вместе с замерами этапов
+    и приращениями счётчиков."""
+    global _span_sink, _counter_sink
+    _span_sink, _counter_sink = [], []
+    try:
+        return fn(*args), (_span_sink, _counter_sink)
+    finally:
+        _span_sink = _counter_sink = None
+
+
+def record_spans(report: Report) -> None:
+    """Переносит замеры из воркера пула в метрики этого процесса."""
+    spans, counters = report
+    for stage, elapsed in spans:
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+    for name, key, amount in counters:
+        metric = REGISTRY.get(name)
+        if isinstance(metric, Counter):
+            metric._add(key, amount)
+
+
+# --- event loop ---
+
+
+async def monitor_loop_lag(interval: float = 0.5) -> None:
+    """Раз в ``interval`` записывает опоздание пробуждения в ``LOOP_LAG``."""
+    loop = asyncio.get_running_loop()
+    while True:
+        t0 = loop.time()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0.0, loop.time() - t0 - interval))
+
+
+# --- профайлер ---
+
+_profile_lock = threading.Lock()
+
+
+def sample_stacks(seconds: float = 10.0, hz: float = 100.0) -> str:
+    """Снимает стеки всех потоков ``seconds`` секунд и сворачивает их в строки
+    ``поток;функция;функция… число`` (вершина стека — справа).
+
+    Блокирует вызывающий поток; одновременно идёт только одна выборка.
+    """
+    seconds = min(max(seconds, 0.1), 60.0)
+    interval = 1.0 / min(max(hz, 1.0), 1000.0)
+    me = threading.get_ident()
+    tally: _Tally[str] = _Tally()
+    with _profile_lock:
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                f: Any = frame
+                while f is not None:
+                    code = f.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)})")
+                    f = f.f_back
+                stack.append(names.get(ident, str(ident)))
+                tally[";".join(reversed(stack))] += 1
+            time.sleep(interval)
+    return "".join(f"{stack} {n}\n" for stack, n in tally.most_common())
+
+
+# --- HTTP ---
+
+
+def add_aiohttp_routes(app: Any) -> None:
+    """``/metrics`` (и ``/debug/profile``, если включён) для aiohttp-приложения."""
+    from aiohttp import web
+
+    async def metrics(request: web.Request) -> web.Response:
+        return web.Response(body=render().encode(), headers={"Content-Type": CONTENT_TYPE})
+
+    async def profile(request: web.Request) -> web.Response:
+        seconds = float(request.query.get("seconds", 10))
+        hz = float(request.query.get("hz", 100))
+        # Выборка идёт в потоке: event loop продолжает работать и попадает в стеки
+        folded = await asyncio.to_thread(sample_stacks, seconds, hz)
+        return web.Response(text=folded)
+
+    app.router.add_get("/metrics", metrics)
+    if PROFILER_ENABLED:
+        app.router.add_get("/debug/profile", profile)
+
+
+def add_flask_routes(app: Any) -> None:
+    """То же для Flask-приложения."""
+    from flask import Response, request
+
+    @app.get("/metrics")
+    def metrics() -> Response:
+        return Response(render(), headers={"Content-Type": CONTENT_TYPE})
+
+    if PROFILER_ENABLED:
+
+        @app.get("/debug/profile")
+        def profile() -> Response:
+            seconds = float(request.args.get("seconds", 10))
+            hz = float(request.args.get("hz", 100))
+            return Response(sample_stacks(seconds, hz), mimetype="text/plain")
@@ -0,0 +1,163 @@
+"""Предварительный рендер, пока пользователь выбирает число открытий.
+
+Как только известны фото и подпись, бот скачивает исходник, накладывает
+водяной знак и сохраняет файл, не дожидаясь числа X. Готовый результат
+(«артефакт») держится в памяти процесса по ключу диалога; ``on_views`` забирает
+его через ``take`` и остаётся только вставить запись ссылки и ответить.
+
+Результат привязан к подписи: если фото или текст поменялись, прежний рендер
+отменяется, а его файлы, на которые так и не появилась ссылка, удаляются.
+То же — если число X не пришло за ``ttl`` секунд. Файл с тем же содержимым
+может понадобиться другой ссылке или быть убран сборщиком сирот, поэтому
+артефакт хранит и байты: ``create_link`` при необходимости запишет файл заново.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+from .links import discard_files
+from .metrics import PRERENDERS
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Artifact:
+    """Готовый результат рендера и файл, куда он сохранён."""
+
+    content: bytes
+    path: Path
+
+
+# file_unique_id исходника → артефакт
+Result = dict[str, Artifact]
+# Что отрендерено: file_unique_id исходников, подпись, профиль кодирования
+Signature = tuple[tuple[str, ...], str, str]
+
+
+@dataclass
+class _Pending:
+    signature: Signature
+    task: asyncio.Task[Result]
+    timer: Optional[asyncio.TimerHandle] = None
+
+
+class Prerenders:
+    """Незавершённые и готовые предварительные рендеры по ключу диалога.
+
+    Живёт в event loop бота и используется только из него. Одновременно держится
+    не больше ``max_pending`` рендеров: результаты лежат в памяти. ``ttl <= 0``
+    отключает предварительный рендер.
+    """
+
+    def __init__(self, ttl: float = 300.0, max_pending: int = 64) -> None:
+        self.ttl = ttl
+        self.max_pending = max_pending
+        self._pending: dict[Hashable, _Pending] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def start(
+        self,
+        key: Hashable,
+        signature: Signature,
+        factory: Callable[[], Awaitable[Result]],
+    ) -> bool:
+        """Запускает ``factory()`` в фоне для диалога ``key``.
+
+        Тот же рендер уже идёт — ничего не делает; другой — отменяет прежний.
+        Возвращает ``False``, если рендер не запущен.
+        """
+        if not self.enabled:
+            return False
+        pending = self._pending.get(key)
+        if pending is not None:
+            if pending.signature == signature:
+                return True
+            self._drop(key, "superseded")
+        if len(self._pending) >= self.max_pending:
+            PRERENDERS.inc(result="skipped")
+            return False
+
+        task = asyncio.ensure_future(factory())
+        task.add_done_callback(_log_failure)
+        timer = asyncio.get_running_loop().call_later(self.ttl, self._expire, key, task)
+        self._pending[key] = _Pending(signature, task, timer)
+        return True
+
+    async def take(self, key: Hashable, signature: Signature) -> Result:
+        """Забирает результат для ``key``, дождавшись рендера, если он ещё идёт.
+
+        Пустой словарь — рендера нет, он для другой подписи или завершился
+        ошибкой: вызывающий рендерит сам.
+        """
+        pending = self._pending.get(key)
+        if pending is None:
+            PRERENDERS.inc(result="miss")
+            return {}
+        if pending.signature != signature:
+            self._drop(key, "superseded")
+            PRERENDERS.inc(result="miss")
+            return {}
+        del self._pending[key]
+        if pending.timer is not None:
+            pending.timer.cancel()
+        try:
+            result = await pending.task
+        except Exception:
+            PRERENDERS.inc(result="failed")
+            return {}
+        PRERENDERS.inc(result="hit")
+        return result
+
+    def cancel(self, key: Hashable) -> None:
+        """Диалог начался заново — незабранный рендер больше не нужен."""
+        if key in self._pending:
+            self._drop(key, "superseded")
+
+    def release(self, result: Result) -> None:
+        """Удаляет файлы результата, если на них так и не появилась ссылка."""
+        if result:
+            discard_files(artifact.path for artifact in result.values())
+
+    def _expire(self, key: Hashable, task: asyncio.Task[Result]) -> None:
+        pending = self._pending.get(key)
+        if pending is not None and pending.task is task:
+            self._drop(key, "expired")
+
+    def _drop(self, key: Hashable, reason: str) -> None:
+        pending = self._pending.pop(key)
+        if pending.timer is not None:
+            pending.timer.cancel()
+        PRERENDERS.inc(result=reason)
+        if not pending.task.done():
+            # Файлы сохраняются после последнего await, поэтому отменённая
+            # задача ничего не оставляет на диске
+            pending.task.cancel()
+        elif not pending.task.cancelled() and pending.task.exception() is None:
+            self.release(pending.task.result())
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "pending": len(self._pending),
+            "ready": sum(1 for p in self._pending.values() if p.task.done()),
+        }
+
+    def close(self) -> None:
+        for key in list(self._pending):
+            self._drop(key, "cancelled")
+
+
+def _log_failure(task: asyncio.Task[Result]) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        logger.info("Предварительный рендер не удался: %r", task.exception())
@@ -0,0 +1,179 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Any, Callable, Optional, TypeVar
+
+from .metrics import RENDERS, Report, call_with_spans, record_spans, span
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+def python_executable() -> Optional[str]:
+    """Интерпретатор Python для spawn-процессов пула; ``None`` — не нашёлся.
+
+    Под uWSGI (веб-приложение PythonAnywhere) ``sys.executable`` — бинарник
+    uWSGI, и spawn запустил бы его вместо Python. Тогда берём интерпретатор
+    окружения из ``sys.prefix`` (virtualenv) или ``sys.base_prefix``.
+    """
+    if getattr(sys, "frozen", False):
+        return sys.executable  # PyInstaller: exe сам запускает воркеры multiprocessing
+    exe = Path(sys.executable or "")
+    if exe.name and "uwsgi" not in exe.name.lower():
+        return str(exe)
+    version = f"{sys.version_info[0]}.{sys.version_info[1]}"
+    for prefix in dict.fromkeys((sys.prefix, sys.base_prefix)):
+        for name in (f"bin/python{version}", "bin/python3", "bin/python", "python.exe"):
+            candidate = Path(prefix) / name
+            if candidate.is_file() and os.access(candidate, os.X_OK):
+                return str(candidate)
+    return None
+
+
+def _call_in_thread(fn: Callable[..., Any], *args: Any) -> tuple[Any, Report]:
+    # Замеры потока сразу попадают в метрики процесса: переносить нечего
+    return fn(*args), ([], [])
+
+
+class RenderBusyError(RuntimeError):
+    """Очередь рендера заполнена — запрос отклонён сразу, без ожидания."""
+
+
+class RenderService:
+    """Пул процессов для тяжёлых операций с изображениями.
+
+    Рендер (декодирование, наложение, JPEG) выполняется вне event loop, поэтому
+    один большой снимок не останавливает обработку апдейтов других пользователей.
+    Одновременно принимается не больше ``workers + max_queue`` задач; сверх этого
+    ``run`` сразу бросает :class:`RenderBusyError`.
+
+    Если интерпретатор Python для процессов не найден (см.
+    :func:`python_executable`), рендер идёт в потоках этого процесса: Pillow
+    отпускает GIL на декодировании и кодировании.
+    """
+
+    def __init__(self, workers: int, max_queue: int, timeout: float) -> None:
+        self.workers = max(1, workers)
+        self.max_queue = max(0, max_queue)
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._pool: Optional[Executor] = None
+        self._threads = False
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def _executor(self) -> Executor:
+        if self._pool is None:
+            executable = python_executable()
+            if executable is None:
+                logger.warning("Интерпретатор Python не найден — рендер идёт в потоках процесса")
+                self._threads = True
+                self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix="render")
+                return self._pool
+            # spawn: форк процесса с живым event loop и потоками aiogram небезопасен
+            ctx = multiprocessing.get_context("spawn")
+            ctx.set_executable(executable)
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx)
+        return self._pool
+
+    def _acquire(self) -> None:
+        with self._lock:
+            if self._in_flight >= self.workers + self.max_queue:
+                raise RenderBusyError("render queue is full")
+            self._in_flight += 1
+
+    def _release(self, _: Future[Any] | None = None) -> None:
+        with self._lock:
+            self._in_flight -= 1
+
+    def _submit(self, fn: Callable[..., T], *args: Any) -> Future[tuple[T, Report]]:
+        pool = self._executor()
+        # В потоке call_with_spans перехватил бы замеры всего процесса
+        call = _call_in_thread if self._threads else call_with_spans
+        try:
+            return pool.submit(call, fn, *args)
+        except BrokenProcessPool:
+            # Воркер упал (например, OOM) — пересоздаём пул один раз
+            self._pool = None
+            return self._executor().submit(call, fn, *args)
+
+    @property
+    def queued(self) -> int:
+        """Заданий, ждущих свободного воркера."""
+        return max(0, self._in_flight - self.workers)
+
+    async def run(self, fn: Callable[..., T], *args: Any) -> T:
+        """Выполняет ``fn(*args)`` в пуле и ждёт результат не дольше ``timeout``.
+
+        Слот освобождается, когда задача реально завершилась в воркере, а не по
+        таймауту, — иначе зависшие рендеры незаметно переполнили бы пул. Поэтому
+        задача, которая по таймауту ещё выполняется, останавливается вместе со
+        своим пулом (см. :meth:`_recycle`). Этапы, замеренные в воркере, попадают
+        в метрики этого процесса.
+        """
+        try:
+            self._acquire()
+        except RenderBusyError:
+            RENDERS.inc(result="busy")
+            raise
+        try:
+            fut = self._submit(fn, *args)
+        except BaseException:
+            self._release()
+            raise
+        pool = self._pool
+        fut.add_done_callback(self._release)
+        try:
+            with span("render"):
+                result, report = await asyncio.wait_for(
+                    asyncio.wrap_future(fut), timeout=self.timeout
+                )
+        except TimeoutError:
+            RENDERS.inc(result="timeout")
+            # Ещё не начатую задачу wait_for уже отменил; начатую держит воркер
+            if fut.running() and pool is not None:
+                self._recycle(pool)
+            raise
+        except BaseException:
+            RENDERS.inc(result="error")
+            raise
+        RENDERS.inc(result="ok")
+        record_spans(report)
+        return result
+
+    def _recycle(self, pool: Executor) -> None:
+        """Останавливает пул с зависшей задачей; следующая задача создаст новый.
+
+        Процессы пула завершаются принудительно: задачи в них (и зависшая, и
+        соседние) получают ``BrokenProcessPool`` и освобождают слоты. Поток
+        остановить нельзя, поэтому в режиме потоков зависшая задача держит слот
+        до конца.
+        """
+        if not isinstance(pool, ProcessPoolExecutor):
+            logger.warning("Рендер превысил таймаут; поток нельзя остановить")
+            return
+        logger.warning("Рендер превысил таймаут — пул процессов перезапускается")
+        if self._pool is pool:
+            self._pool = None
+        # Публичного способа остановить занятые процессы у ProcessPoolExecutor нет
+        processes = list((pool._processes or {}).values())
+        pool.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.terminate()
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
@@ -0,0 +1,132 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Optional, TypeVar
+
+from .links import DATA_DIR
+
+SENT_DB_PATH = DATA_DIR / "sent.db"
+
+T = TypeVar("T")
+
+
+def sent_key(source_uid: str, text: str, *params: object) -> str:
+    """Ключ результата: исходный файл (``file_unique_id``), подпись и параметры рендера."""
+    raw = "\0".join([source_uid, text, *map(str, params)])
+    return hashlib.blake2b(raw.encode(), digest_size=16).hexdigest()
+
+
+class SentPhotoCache:
+    """Какие результаты уже отправлялись в Telegram: ключ → ``file_id`` фото и файл.
+
+    Повторный запрос с тем же исходником, подписью и параметрами обходится без
+    рендера и без загрузки: фото отправляется по ``file_id``, а ссылка ведёт на
+    уже сохранённый файл. Хранится в SQLite, поэтому переживает перезапуск и
+    общий для процессов бота. Запросы идут в отдельном потоке БД, как у
+    :class:`bot.fsm.SQLiteStorage`: event loop не ждёт блокировку записи.
+    Хранится не больше ``max_entries`` записей, давно не использованные удаляются.
+    """
+
+    def __init__(self, path: Path = SENT_DB_PATH, max_entries: int = 100_000) -> None:
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # Одна нить на соединение: sqlite3 не любит делить соединение между потоками
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sent-sqlite")
+        self._db: Optional[sqlite3.Connection] = None
+        self._writes = 0
+
+    # --- операции в потоке БД ---
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS sent (
+                    key TEXT PRIMARY KEY,
+                    file_id TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    used_at REAL NOT NULL
+                ) WITHOUT ROWID
+                """
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS sent_used ON sent(used_at)")
+            self._db = db
+        return self._db
+
+    def _get(self, key: str) -> Optional[tuple[str, Path]]:
+        rows = (
+            self._connect()
+            .execute(
+                "UPDATE sent SET used_at = ? WHERE key = ? RETURNING file_id, path",
+                (time.time(), key),
+            )
+            .fetchall()
+        )
+        if not rows:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return rows[0][0], Path(rows[0][1])
+
+    def _contains(self, key: str) -> bool:
+        row = self._connect().execute("SELECT 1 FROM sent WHERE key = ?", (key,)).fetchone()
+        return row is not None
+
+    def _put(self, key: str, file_id: str, path: Path) -> None:
+        db = self._connect()
+        db.execute(
+            "INSERT OR REPLACE INTO sent(key, file_id, path, used_at) VALUES (?, ?, ?, ?)",
+            (key, file_id, str(path), time.time()),
+        )
+        self._writes += 1
+        if self._writes % 1000 == 0:
+            db.execute(
+                "DELETE FROM sent WHERE key IN "
+                "(SELECT key FROM sent ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def _forget(self, key: str) -> None:
+        self._connect().execute("DELETE FROM sent WHERE key = ?", (key,))
+
+    def _close_db(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    # --- асинхронная часть ---
+
+    async def _run(self, fn: Callable[..., T], *args: Any) -> T:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def get(self, key: str) -> Optional[tuple[str, Path]]:
+        return await self._run(self._get, key)
+
+    async def contains(self, key: str) -> bool:
+        """Есть ли запись — без обновления ``used_at`` и статистики попаданий."""
+        return await self._run(self._contains, key)
+
+    async def put(self, key: str, file_id: str, path: Path) -> None:
+        await self._run(self._put, key, file_id, path)
+
+    async def forget(self, key: str) -> None:
+        """Убирает запись, например если Telegram больше не принимает ``file_id``."""
+        await self._run(self._forget, key)
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
+
+    def close(self) -> None:
+        self._executor.submit(self._close_db)
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import Message, TelegramObject
+
+
+@dataclass
+class _Bucket:
+    tokens: float
+    updated: float
+    warned: bool = False
+
+
+class TokenBuckets:
+    """Корзины токенов по ключу: ``burst`` сообщений подряд, дальше ``rate`` в секунду."""
+
+    def __init__(self, rate: float, burst: int, max_keys: int = 10000) -> None:
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_keys = max_keys
+        self._buckets: dict[int, _Bucket] = {}
+
+    def _refilled(self, bucket: _Bucket, now: float) -> float:
+        return min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+
+    def take(self, key: int) -> Optional[_Bucket]:
+        """Списывает токен; ``None`` — токен есть, иначе пустая корзина ключа."""
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_keys:
+                self._prune(now)
+            self._buckets[key] = _Bucket(tokens=self.burst - 1, updated=now)
+            return None
+        bucket.tokens = self._refilled(bucket, now)
+        bucket.updated = now
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            bucket.warned = False
+            return None
+        return bucket
+
+    def _prune(self, now: float) -> None:
+        # Полная корзина ничем не отличается от отсутствующей
+        full = [k for k, b in self._buckets.items() if self._refilled(b, now) >= self.burst]
+        for key in full:
+            del self._buckets[key]
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Ограничивает сообщения от одного чата и число тяжёлых обработок сразу.
+
+    - Каждый чат тратит токен на сообщение (``rate_per_min`` в минуту, до
+      ``burst`` подряд). Кто превысил — получает одно вежливое предупреждение,
+      дальнейшие сообщения до пополнения корзины молча пропускаются. Альбом
+      (части с одним ``media_group_id``) стоит один токен: иначе альбом из 10 фото
+      после любого другого сообщения упирался бы в ``burst`` и терял части.
+    - Обработчики с флагом ``heavy`` (скачивание + рендер) выполняются не больше
+      ``max_inflight`` одновременно на процесс; сверх этого пользователь сразу
+      получает просьбу повторить, а не ждёт в очереди.
+
+    Лимиты действуют в пределах процесса.
+    """
+
+    def __init__(
+        self, rate_per_min: float, burst: int, max_inflight: int, max_groups: int = 1000
+    ) -> None:
+        self.buckets = TokenBuckets(rate_per_min / 60.0, burst) if rate_per_min > 0 else None
+        # Решение по первой части альбома действует на все его части (последние max_groups)
+        self.max_groups = max_groups
+        self._groups: OrderedDict[str, Optional[_Bucket]] = OrderedDict()
+        self.max_inflight = max_inflight
+        self.in_flight = 0
+        self.throttled = 0
+        self.rejected = 0
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        if not isinstance(event, Message):
+            return await handler(event, data)
+
+        if self.buckets is not None:
+            bucket = self._take(event, self.buckets)
+            if bucket is not None:
+                self.throttled += 1
+                if not bucket.warned:
+                    bucket.warned = True
+                    await event.answer(
+                        "🐢 Слишком много сообщений. Подожди немного и попробуй снова."
+                    )
+                return None
+
+        if not get_flag(data, "heavy"):
+            return await handler(event, data)
+        if self.max_inflight > 0 and self.in_flight >= self.max_inflight:
+            self.rejected += 1
+            await event.answer("⏳ Сейчас много запросов. Пришли число ещё раз через минуту.")
+            return None
+        self.in_flight += 1
+        try:
+            return await handler(event, data)
+        finally:
+            self.in_flight -= 1
+
+    def _take(self, event: Message, buckets: TokenBuckets) -> Optional[_Bucket]:
+        """Списывает токен за сообщение; части альбома делят решение по первой части."""
+        group_id = event.media_group_id
+        if group_id is not None and group_id in self._groups:
+            return self._groups[group_id]
+        bucket = buckets.take(event.chat.id)
+        if group_id is not None:
+            self._groups[group_id] = bucket
+            if len(self._groups) > self.max_groups:
+                self._groups.popitem(last=False)
+        return bucket
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "in_flight": self.in_flight,
+            "max_inflight": self.max_inflight,
+            "throttled": self.throttled,
+            "rejected": self.rejected,
+            "chats": len(self.buckets) if self.buckets is not None else 0,
+        }
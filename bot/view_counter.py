@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Optional
+
+from .links import Link, fetch_link, subtract_views
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _Entry:
+    path: Path
+    remaining: int
+    expires_at: Optional[float] = None
+    pending: int = 0  # списанные в памяти, но ещё не записанные в БД просмотры
+
+
+class WriteBehindCounter:
+    """Счётчик просмотров в памяти с отложенной записью в SQLite.
+
+    Первый просмотр ссылки читает её из БД, дальнейшие уменьшают счётчик в памяти
+    под блокировкой; накопленные списания пишутся в БД пачкой раз в
+    ``flush_interval`` секунд и при :meth:`close`.
+
+    Семантика:
+
+    - в одном процессе ссылка открывается ровно ``remaining`` раз, как и без кэша;
+    - несколько процессов не знают о списаниях друг друга до записи в БД, поэтому
+      ссылка может открыться до ``N × remaining`` раз (N — число процессов).
+      Значение в БД не уходит ниже нуля. Если нужна точность — один процесс
+      или режим без кэша;
+    - при аварийном завершении теряются списания за последний ``flush_interval``
+      (ссылка откроется на столько же раз больше);
+    - срок жизни (``expires_at``) проверяется при каждом просмотре, как в
+      ``consume_view``; удалённые сборщиком ссылки убираются через :meth:`forget`.
+    """
+
+    def __init__(self, capacity: int = 10000, flush_interval: float = 0.5) -> None:
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._lock = threading.Lock()
+        # Загрузка из БД и запись списаний не пересекаются: иначе ссылку, вытесненную
+        # между обнулением pending и коммитом, можно было бы прочитать устаревшей
+        self._db_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="view-counter-flush", daemon=True
+            )
+            self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Не удалось записать счётчики просмотров")
+
+    def _load(self, token: str) -> bool:
+        with self._db_lock:
+            link = fetch_link(token)
+            if link is None:
+                return False
+            with self._lock:
+                # Пока читали БД, другой поток мог уже загрузить эту ссылку
+                self._entries.setdefault(
+                    token,
+                    _Entry(path=link.path, remaining=link.remaining, expires_at=link.expires_at),
+                )
+        return True
+
+    def consume(self, token: str) -> Optional[Link]:
+        """То же, что :func:`bot.links.consume_view`, но без записи в БД на каждый вызов."""
+        while True:
+            with self._lock:
+                entry = self._entries.get(token)
+                if entry is not None:
+                    if entry.expires_at is not None and entry.expires_at <= time.time():
+                        # Просроченная ссылка не открывается; списания ей больше не нужны
+                        del self._entries[token]
+                        return None
+                    self._entries.move_to_end(token)
+                    if entry.remaining <= 0:
+                        return None
+                    entry.remaining -= 1
+                    entry.pending += 1
+                    link = Link(token=token, path=entry.path, remaining=entry.remaining)
+                    break
+            # БД читаем без блокировки; после загрузки повторяем под блокировкой
+            if not self._load(token):
+                return None
+        if len(self._entries) > self.capacity:
+            self._evict()
+        return link
+
+    def flush(self) -> int:
+        """Записывает накопленные списания одной транзакцией; возвращает число ссылок."""
+        with self._db_lock:
+            with self._lock:
+                batch = [(e.pending, t) for t, e in self._entries.items() if e.pending]
+                for _, token in batch:
+                    self._entries[token].pending = 0
+            if not batch:
+                return 0
+            try:
+                subtract_views(batch)
+            except BaseException:
+                # Не удалось записать — вернём списания, чтобы записать в следующий раз
+                with self._lock:
+                    for pending, token in batch:
+                        entry = self._entries.get(token)
+                        if entry is not None:
+                            entry.pending += pending
+                raise
+        return len(batch)
+
+    def forget(self, tokens: Iterable[str]) -> None:
+        """Убирает ссылки из памяти (например, после удаления записей сборщиком)."""
+        with self._lock:
+            for token in tokens:
+                self._entries.pop(token, None)
+
+    def _evict(self) -> None:
+        self.flush()
+        with self._lock:
+            while len(self._entries) > self.capacity:
+                token, entry = next(iter(self._entries.items()))
+                if entry.pending:
+                    break
+                del self._entries[token]
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
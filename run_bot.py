@@ -1,6 +1,9 @@
 import asyncio
+import multiprocessing
 
 from bot.main import main
 
 if __name__ == "__main__":
+    # Нужно для пула рендера в onefile-сборке PyInstaller
+    multiprocessing.freeze_support()
     asyncio.run(main())